@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import platform
+import random
+import statistics
+import tempfile
+
+from datetime import datetime
+from pathlib import Path
+from typing import Final
+
+import pymupdf
+
+import profiler
+
+from main import extract_page, write_pages
+from pdf import PDF
+
+# Words of the synthetic pages
+VOCABULARY: Final = (
+    "alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu nu xi omicron pi rho "
+    "sigma tau upsilon phi chi psi omega"
+).split()
+
+# Stages recorded by the profiler for every page, in the order they run
+STAGES: Final = ("setup_page", "headers", "toc", "highlights", "bold_italic", "formatting", "writing")
+
+FONT_SIZE: Final = 10
+LINE_HEIGHT: Final = 13
+MARGIN: Final = 50
+
+def generate_pdf(
+        path: Path,
+        pages: int = 50,
+        words_per_page: int = 300,
+        highlights: int = 4,
+        quads: int = 3,
+        toc_depth: int = 3,
+        emphasis: float = 0.1,
+        seed: int = 0
+    ) -> None:
+    """
+    Create a PDF with paragraphs, headers, a table of contents and highlights.
+
+    Args:
+        path: Where the PDF is saved
+        pages: Number of pages
+        words_per_page: Words of the paragraphs of every page
+        highlights: Highlight annotations of every page
+        quads: Lines covered by every highlight, one quad per line
+        toc_depth: Levels of the table of contents, at least 2 because the markdown
+            files are named after the second level
+        emphasis: Ratio of words in italic, bold words would be taken as headers
+        seed: Seed of the random generator, the same arguments give the same PDF
+    """
+    rng = random.Random(seed)
+    toc_depth = max(2, toc_depth)
+    doc = pymupdf.open()
+    toc = []
+
+    for page_index in range(pages):
+        page = doc.new_page()
+        y = MARGIN + 10
+
+        # Every chapter opens all the levels, the next pages only add one of the last level
+        first_level = 1 if page_index % toc_depth == 0 else toc_depth
+        for level in range(first_level, toc_depth + 1):
+            title = f"{page_index + 1}.{level} Section about {rng.choice(VOCABULARY)}"
+            font_size = 22 - 3 * level
+            page.insert_text((MARGIN, y), title, fontsize=font_size, fontname="hebo")
+            toc.append([level, title, page_index + 1])
+            y += font_size * 2
+
+        # Rectangle of every line, used for the highlights
+        lines: list[pymupdf.Rect] = []
+        words = 0
+        while words < words_per_page and y < page.rect.height - MARGIN:
+            x = MARGIN
+            line_words = rng.randint(6, 11)
+            for word_index in range(line_words):
+                word = rng.choice(VOCABULARY)
+                if word_index == line_words - 1 and rng.random() < 0.3:
+                    word += "."
+                font = "heit" if rng.random() < emphasis else "helv"
+                page.insert_text((x, y), word, fontsize=FONT_SIZE, fontname=font)
+                x += pymupdf.get_text_length(word + " ", fontname=font, fontsize=FONT_SIZE)
+            lines.append(pymupdf.Rect(MARGIN, y - FONT_SIZE, x, y + 3))
+            words += line_words
+            y += LINE_HEIGHT
+
+        for _ in range(min(highlights, len(lines))):
+            first_line = rng.randrange(len(lines))
+            highlighted = lines[first_line : first_line + quads]
+            page.add_highlight_annot(quads=[rect.quad for rect in highlighted])
+
+    doc.set_toc(toc)
+    doc.save(path)
+
+def run_benchmark(pdf_path: Path) -> dict[str, list[float]]:
+    """
+    Extract and write every page with highlights like the extractor does, with
+    the profiler enabled to time each stage.
+
+    Returns:
+        The seconds of every stage on every page {stage: [seconds]}
+    """
+    run_profiler = profiler.enable()
+    try:
+        pdf = PDF(str(pdf_path))
+        page_texts = [(page_no, extract_page(pdf, page_no)) for page_no in pdf.get_highlighted_pages()]
+        pdf.doc.close()
+
+        # The pages are written after the extraction, so the writing thread doesn't slow it down
+        with tempfile.TemporaryDirectory() as workspace:
+            write_pages(page_texts, Path(workspace))
+        stages = run_profiler.take()["stages"]
+    finally:
+        profiler.disable()
+    return {stage: stages.get(stage, []) for stage in STAGES}
+
+def summarize(runs: list[dict[str, list[float]]]) -> dict:
+    """Get the total seconds of every stage of the fastest run and their median over the runs"""
+    stages = {}
+    for stage in STAGES:
+        totals = [sum(run[stage]) for run in runs]
+        stages[stage] = {"best": min(totals), "median": statistics.median(totals)}
+
+    best_total = min(sum(sum(times) for times in run.values()) for run in runs)
+    pages = len(runs[0]["setup_page"])
+    return {
+        "stages": stages,
+        "pages": pages,
+        "seconds": best_total,
+        "pages_per_second": pages / best_total if best_total else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the extraction of a synthetic PDF with highlights")
+    parser.add_argument("--pages", type=int, default=50, help="Pages of the synthetic PDF")
+    parser.add_argument("--words", type=int, default=300, help="Words of every page")
+    parser.add_argument("--highlights", type=int, default=4, help="Highlight annotations of every page")
+    parser.add_argument("--quads", type=int, default=3, help="Lines covered by every highlight")
+    parser.add_argument("--toc-depth", type=int, default=3, help="Levels of the table of contents, at least 2")
+    parser.add_argument("--emphasis", type=float, default=0.1, help="Ratio of words in italic")
+    parser.add_argument("--seed", type=int, default=0, help="Seed used to generate the PDF")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs, the best one is reported")
+    parser.add_argument("--pdf", help="Benchmark this PDF instead of generating one")
+    parser.add_argument("--output", help="JSON file where the results are written", default="benchmark.json")
+    args = parser.parse_args()
+
+    # The extraction logs every page
+    logging.getLogger().setLevel(logging.WARNING)
+
+    options = {
+        "pages": args.pages,
+        "words_per_page": args.words,
+        "highlights": args.highlights,
+        "quads": args.quads,
+        "toc_depth": args.toc_depth,
+        "emphasis": args.emphasis,
+        "seed": args.seed,
+    }
+
+    with tempfile.TemporaryDirectory() as folder:
+        pdf_path = Path(args.pdf) if args.pdf else Path(folder) / "synthetic.pdf"
+        if not args.pdf:
+            generate_pdf(pdf_path, **options)
+        runs = [run_benchmark(pdf_path) for _ in range(max(1, args.repeat))]
+
+    results = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pymupdf": pymupdf.VersionBind,
+        "pdf": args.pdf,
+        "options": None if args.pdf else options,
+        "repeat": len(runs),
+        **summarize(runs),
+    }
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=4)
+
+    print(f"{results['pages']} pages in {results['seconds']:.3f}s, results in '{args.output}'")
+    for stage, times in results["stages"].items():
+        print(f"  {stage:<12} {times['best']:.4f}s")
+
+if __name__ == "__main__":
+    main()
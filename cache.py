@@ -0,0 +1,70 @@
+import json
+import logging
+import os
+
+from pathlib import Path
+from typing import Any, Final, Optional
+
+# Change it when the extraction changes its output, older caches are discarded.
+CACHE_VERSION: Final = 5
+
+# Name of the cache file inside the folder of every PDF in the workspace
+CACHE_FILE: Final = ".highlights_cache.json"
+
+class ExtractionCache:
+    """
+    Cache of the extracted pages of a PDF saved as a JSON file.
+
+    A page is reused while the fingerprint of its highlight annotations is the same,
+    having the next format {"page_no": {"fingerprint": str, "headers": list, "text": str}}
+    """
+
+    def __init__(self, path: Path, document_id: str):
+        self.path = path
+        self.document_id = document_id
+        self.pages: dict[str, dict[str, Any]] = {}
+        self.changed = False
+        self.__load()
+
+    def __load(self) -> None:
+        if not self.path.exists():
+            return
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError) as error:
+            logging.warning(f"Cache '{self.path}' can't be read, ignoring it: {error}")
+            return
+
+        if data.get("version") != CACHE_VERSION or data.get("document") != self.document_id:
+            logging.info(f"Cache '{self.path}' is from another version or document, ignoring it")
+            return
+
+        self.pages = data.get("pages", {})
+
+    def get(self, page_no: int, fingerprint: str) -> Optional[tuple[list[tuple[int, str]], str]]:
+        """Get the (headers_per_page, text) of a page if its highlights didn't change"""
+        page = self.pages.get(str(page_no))
+        if page is None or page["fingerprint"] != fingerprint:
+            return None
+        return [tuple(header) for header in page["headers"]], page["text"]
+
+    def put(self, page_no: int, fingerprint: str, headers_per_page: list[tuple[int, str]], text: str) -> None:
+        self.pages[str(page_no)] = {"fingerprint": fingerprint, "headers": headers_per_page, "text": text}
+        self.changed = True
+
+    def save(self) -> None:
+        """Write the cache if something changed, the file is replaced at once"""
+        if not self.changed:
+            return
+
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(
+                {"version": CACHE_VERSION, "document": self.document_id, "pages": self.pages},
+                file,
+                ensure_ascii=False,
+            )
+        os.replace(temp_path, self.path)
+        self.changed = False
@@ -0,0 +1,59 @@
+import math
+
+from typing import Any, Final, Optional
+
+class FontProfile:
+    """
+    Histogram of the font sizes of a document weighted by the characters of every span.
+
+    It is filled incrementally with the spans of the pages, the threshold used to
+    find the headers is computed only when the histogram changed.
+    """
+
+    # Decimals kept of every size, close sizes share the same bin
+    SIZE_DECIMALS: Final = 1
+
+    def __init__(self):
+        self.histogram: dict[float, int] = {}
+        self.__threshold: Optional[float] = None
+
+    def __len__(self) -> int:
+        """Number of characters in the histogram"""
+        return sum(self.histogram.values())
+
+    def add(self, size: float, weight: int = 1) -> None:
+        size = round(size, self.SIZE_DECIMALS)
+        self.histogram[size] = self.histogram.get(size, 0) + weight
+        self.__threshold = None
+
+    def add_span(self, span: dict[str, Any]) -> None:
+        """Add the size of a span of a pymupdf dict, weighted by its characters"""
+        characters = len(span["text"].strip())
+        if characters:
+            self.add(span["size"], characters)
+
+    @property
+    def threshold(self) -> float:
+        """Font size above which the text is a header, the median plus the standard deviation"""
+        if self.__threshold is None:
+            self.__threshold = self.__calculate_threshold()
+        return self.__threshold
+
+    def __calculate_threshold(self) -> float:
+        total = len(self)
+        if not total:
+            return 0.0
+
+        sizes = sorted(self.histogram)
+        mean = sum(size * self.histogram[size] for size in sizes) / total
+        variance = sum((size - mean) ** 2 * self.histogram[size] for size in sizes) / total
+
+        # Weighted median, the size of the character in the middle
+        seen = 0
+        median = sizes[-1]
+        for size in sizes:
+            seen += self.histogram[size]
+            if seen * 2 >= total:
+                median = size
+                break
+        return median + math.sqrt(variance)
@@ -3,11 +3,26 @@
 import logging
 import json
 import argparse
-from datetime import datetime
+import glob
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from pathlib import Path
-from typing import TextIO
+from typing import Iterable, Iterator, Optional
+from cache import CACHE_FILE, ExtractionCache
+from fonts import FontProfile
+from memory import peak_rss
 from pdf import PDF
+import profiler
+from store import HighlightStore
+from writer import BackgroundWriter, find_page_files
+
+# (headers_per_page, text) of a page, None when the page doesn't have highlights
+PageText = Optional[tuple[list[tuple[int, str]], str]]
+
+# PDF opened by each worker process, see extract_pages_parallel
+_worker_pdf: Optional[PDF] = None
 
 logging.basicConfig(
     level=logging.INFO,
@@ -20,80 +35,652 @@ def create_folder(path: Path):
         logging.info(f"Folder '{path}' doesn't exist, creating folder")
         path.mkdir(parents=True, exist_ok=True)
 
-def page_is_duplicated(file: TextIO, text: str) -> bool:
-    """Check if the line 'Page: X' is already in the text
+def extract_page(pdf: PDF, page_no: int) -> PageText:
+    """Get the header hierarchy and the markdown text of a page"""
+    result = pdf.extract_page(page_no)
+    # The text of pages without highlights is not parsed
+    if not result.highlight_count:
+        return None
+    return list(result.headers), result.text
 
-    Args:
-        file (TextIO): A file already open to be processed
-        text (str): Text where duplicates are found
+def _init_worker(
+        pdf_path: str,
+        memory_budget: Optional[int] = None,
+        profile: bool = False,
+        font_profile: Optional[FontProfile] = None
+    ):
+    global _worker_pdf
+    _worker_pdf = PDF(pdf_path, memory_budget, font_profile)
+    if profile:
+        profiler.enable()
+
+def _extract_chunk(pages: list[int]) -> tuple[list[tuple[int, PageText, Optional[Exception]]], Optional[dict]]:
+    """
+    Extract a chunk of pages in a worker process, errors are returned to be raised in order.
 
     Returns:
-        bool: True if the 'Page: X' is duplocated, False othewise.
+        The result of every page and what the profiler of the worker recorded.
+    """
+    results = []
+    for page_no in pages:
+        try:
+            results.append((page_no, extract_page(_worker_pdf, page_no), None))
+        except Exception as error:
+            results.append((page_no, None, error))
+    return results, profiler.get_profiler().take()
+
+def extract_pages_parallel(
+        pdf_path: Path,
+        pages: Iterable[int],
+        workers: int,
+        memory_budget: Optional[int] = None,
+        font_profile: Optional[FontProfile] = None
+    ) -> Iterator[tuple[int, PageText]]:
     """
-    page_lines = {line.strip() for line in file if line.startswith("Page: ")}
-    return any(page in text for page in page_lines)
+    Extract the pages using a pool of processes, each process opens its own document
+    with the same memory budget and the font profile built by the caller, if any.
 
-def write_file(file: Path, text: str, page_no: int):
-    """Create a new file if it doesn't exist or append the text to an existing file"""
-    if not file.exists():
-        logging.info(f"Markdown file '{file}' doesn't exist, creating file with PDF page {page_no}")
+    Yields:
+        (page_no, page_text) in the same order of pages.
+    """
+    pages = list(pages)
+    # Several chunks per worker to balance pages with a lot of highlights
+    chunk_size = max(1, -(-len(pages) // (workers * 4)))
+    chunks = [pages[i : i + chunk_size] for i in range(0, len(pages), chunk_size)]
 
-        final_text = f"""
----
+    initargs = (str(pdf_path), memory_budget, profiler.get_profiler().enabled, font_profile)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as executor:
+        for future in [executor.submit(_extract_chunk, chunk) for chunk in chunks]:
+            results, records = future.result()
+            profiler.get_profiler().merge(records)
+            for page_no, page_text, error in results:
+                if error is not None:
+                    executor.shutdown(cancel_futures=True)
+                    raise error
+                yield page_no, page_text
 
-# Created: {datetime.now().isoformat(timespec="seconds")}
+def extract_pages(
+        pdf: PDF,
+        pages: Iterable[int],
+        workers: int = 1,
+        cache: Optional[ExtractionCache] = None
+    ) -> Iterator[tuple[int, PageText]]:
+    """
+    Extract the pages, reusing the cached pages whose highlights didn't change.
 
----\n\n{text}"""
+    Yields:
+        (page_no, page_text) in the same order of pages.
+    """
+    pages = list(pages)
+    if cache is None:
+        missing = pages
+    else:
+        fingerprints = {page_no: pdf.get_highlight_fingerprint(page_no) for page_no in pages}
+        cached = {
+            page_no: cache.get(page_no, fingerprint)
+            for page_no, fingerprint in fingerprints.items()
+            if fingerprint is not None
+        }
+        # Pages without highlights don't need to be extracted
+        missing = [page_no for page_no in pages if fingerprints[page_no] is not None and cached[page_no] is None]
+        reused = sum(1 for page_text in cached.values() if page_text is not None)
+        logging.info(f"Reusing {reused} pages from the cache, extracting {len(missing)} pages")
 
-        file.write_text(final_text)
+    if workers > 1 and missing:
+        # The font profile is built once here instead of in every worker
+        page_texts = extract_pages_parallel(
+            Path(pdf.pdf_path), missing, workers, pdf.memory_budget, pdf.font_profile
+        )
     else:
-        with open(file, mode="r+", encoding="utf-8") as f:
-            duplicated = page_is_duplicated(f, text)
-            if duplicated:
-                logging.info(f"Page {page_no} already exist. Skipping.")
-            else:
-                logging.info(f"Markdown file exist, using existing file '{file}' with PDF page {page_no}")
-                f.write(text)
+        page_texts = ((page_no, extract_page(pdf, page_no)) for page_no in missing)
+
+    if cache is None:
+        yield from page_texts
+        return
+
+    for page_no in pages:
+        if fingerprints[page_no] is None:
+            yield page_no, None
+        elif cached[page_no] is not None:
+            yield page_no, cached[page_no]
+        else:
+            _, page_text = next(page_texts)
+            if page_text is not None:
+                cache.put(page_no, fingerprints[page_no], *page_text)
+            yield page_no, page_text
 
 def load_config(config_path: str) -> dict:
     with open(config_path, "r", encoding="utf-8") as file:
         return json.load(file)
 
+def get_documents(config: dict, pdf_paths: Optional[list[str]] = None) -> list[dict]:
+    """
+    Get the PDFs to process with their own options.
+
+    The PDFs come from pdf_paths, the "pdf_paths" list of the config or its "pdf_path".
+    Every item is a path, a glob, or a dict with "pdf_path" and its own page_start,
+    page_end and auto_pages. The options missing in a dict are taken from the config.
+    A PDF found by several items is processed once with the options of the last one.
+
+    A path that exists is never taken as a glob, even with "*?[" in its name. A glob
+    that finds no PDF is kept as a path, so it fails like a missing PDF when processed.
+
+    Returns:
+        A list of dicts with the pdf_path already expanded and its options.
+    """
+    defaults = {key: config[key] for key in ("page_start", "page_end", "auto_pages") if key in config}
+    entries = pdf_paths or config.get("pdf_paths") or [config["pdf_path"]]
+
+    # Documents by their resolved path, in the order they were found first
+    documents: dict[Path, dict] = {}
+    for entry in entries:
+        options = {**defaults, **(entry if isinstance(entry, dict) else {"pdf_path": entry})}
+        path = str(Path(options["pdf_path"]).expanduser())
+
+        paths = [Path(path)]
+        if not paths[0].exists() and any(char in path for char in "*?["):
+            found = sorted(Path(p) for p in glob.glob(path, recursive=True) if p.lower().endswith(".pdf"))
+            if found:
+                paths = found
+            else:
+                logging.warning(f"No PDF found for '{path}'")
+
+        for p in paths:
+            if p.resolve() in documents:
+                logging.info(f"'{p}' is listed more than once, using its last options")
+            documents[p.resolve()] = {**options, "pdf_path": p}
+    return list(documents.values())
+
+def get_pages(pdf: PDF, document: dict, auto_pages: bool = False) -> list[int]:
+    """Get the pages to process of a document, its page range or the pages with highlights"""
+    # Without a page range, look for the pages with highlights in the whole document
+    if auto_pages or document.get("auto_pages", False) or "page_start" not in document:
+        pages = pdf.get_highlighted_pages()
+        logging.info(f"Found {len(pages)} pages with highlights")
+        return pages
+    return list(range(int(document["page_start"]), int(document["page_end"])))
+
+def process_document(
+        document: dict,
+        workspace: Path,
+        auto_pages: bool = False,
+        workers: int = 1,
+        use_cache: bool = True,
+        ordered: bool = False,
+        memory_budget: Optional[int] = None,
+        pdf: Optional[PDF] = None,
+        database: Optional[Path] = None
+    ) -> dict:
+    """
+    Extract the highlights of a PDF into its folder of the workspace.
+
+    Args:
+        document: The pdf_path and its options, see get_documents
+        workspace: Folder where the folder of every PDF is created
+        auto_pages: Process only the pages with highlights even if there is a page range
+        workers: Number of processes used to extract the pages
+        use_cache: Reuse the pages extracted by previous runs whose highlights didn't change
+        ordered: Insert the pages in the markdown files by page number instead of appending them
+        memory_budget: Bytes each process should use at most, see PDF
+        pdf: The document already opened, by default it is opened here
+        database: SQLite database where the pages are also stored, see HighlightStore
+
+    Returns:
+        A summary with the pdf_path, the processed pages, the written pages and the seconds it took.
+    """
+    start = time.perf_counter()
+    file_path = document["pdf_path"]
+    pdf = pdf or PDF(file_path, memory_budget)
+    bookname = workspace / file_path.stem
+    pages = get_pages(pdf, document, auto_pages)
+
+    cache = ExtractionCache(bookname / CACHE_FILE, pdf.get_document_id()) if use_cache else None
+    page_texts = extract_pages(pdf, pages, workers, cache)
+
+    create_folder(bookname)
+    store = HighlightStore(database) if database is not None else None
+    try:
+        if store is not None:
+            page_texts = store_pages(page_texts, store, pdf, file_path.stem)
+        written, processed = write_pages(page_texts, bookname, ordered)
+    finally:
+        if cache is not None:
+            cache.save()
+        if store is not None:
+            store.close()
+
+    return {
+        "pdf_path": str(file_path),
+        "pages": processed,
+        "written": written,
+        "seconds": round(time.perf_counter() - start, 2),
+    }
+
+def write_pages(
+        page_texts: Iterable[tuple[int, PageText]],
+        bookname: Path,
+        ordered: bool = False,
+        replace: bool = False,
+        page_files: Optional[dict[int, Path]] = None
+    ) -> tuple[int, int]:
+    """
+    Write every page in the markdown file of its header, the files are written
+    in a thread while the next pages are extracted.
+
+    Args:
+        page_texts: (page_no, page_text) of every page
+        bookname: Folder of the PDF in the workspace
+        ordered: Insert the pages by page number instead of appending them, see MarkdownWriter
+        replace: Replace the text of the pages already written instead of skipping them
+        page_files: Markdown file of the pages written before {page_no: file}, see find_page_files.
+            A page without headers goes to the file of the nearest page before it, from this
+            run or from page_files.
+
+    Returns:
+        The number of written pages and the number of processed pages.
+    """
+    last_file: Optional[Path] = None
+    last_page = 0
+    processed = 0
+    folders: set[Path] = set()
+    with BackgroundWriter(ordered, replace=replace) as writer:
+        for page_no, page_text in page_texts:
+            processed += 1
+            if page_text is None:
+                logging.info(f"No highlights on page {page_no}. Skipping.")
+                continue
+
+            headers_per_page, text = page_text
+
+            if not text:
+                logging.info(f"No text to process on page {page_no}. Skipping.")
+                continue
+
+            # As long as the page have headers, create the corresponding md file
+            # otherwise use the last md file.
+            if headers_per_page:
+                subfolder = (bookname / headers_per_page[0][1]).expanduser()
+                file = (subfolder / f"{headers_per_page[1][1]}.md").expanduser()
+                last_file, last_page = file, page_no
+                if subfolder not in folders:
+                    create_folder(subfolder)
+                    folders.add(subfolder)
+            elif page_files:
+                # Only some pages are written, a page before may have set the file
+                previous = max((p for p in page_files if last_page < p < page_no), default=None)
+                if previous is not None:
+                    last_file, last_page = page_files[previous], previous
+
+            if last_file is None:
+                logging.warning(f"No header found on page {page_no} nor on the pages before it. Skipping.")
+                continue
+
+            writer.write(last_file, text, page_no)
+
+    return writer.written, processed
+
+def store_pages(
+        page_texts: Iterable[tuple[int, PageText]],
+        store: HighlightStore,
+        pdf: PDF,
+        book: str
+    ) -> Iterator[tuple[int, PageText]]:
+    """
+    Add every page with text to the store with the rectangles of its highlights.
+
+    Yields:
+        The same (page_no, page_text) of page_texts, to be written after.
+    """
+    for page_no, page_text in page_texts:
+        if page_text is not None and page_text[1]:
+            store.add(book, page_no, *page_text, pdf.get_highlight_bboxes(page_no))
+        yield page_no, page_text
+
+def get_file_state(path: Path) -> Optional[tuple[int, int]]:
+    """Get the modification time and size of a file, None if it doesn't exist"""
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def watch_document(
+        document: dict,
+        workspace: Path,
+        auto_pages: bool = False,
+        workers: int = 1,
+        use_cache: bool = True,
+        ordered: bool = False,
+        memory_budget: Optional[int] = None,
+        interval: float = 1.0,
+        database: Optional[Path] = None
+    ) -> None:
+    """
+    Extract the highlights of a PDF, then keep it open and extract again the pages
+    whose highlights change every time the file is saved, until Ctrl+C.
+
+    The pages already in the markdown files are replaced with their new text,
+    the notes of pages whose highlights were all removed are kept.
+
+    Args:
+        interval: Seconds between two checks of the modification time and size of the file
+        Others: See process_document
+    """
+    file_path = document["pdf_path"]
+    bookname = workspace / file_path.stem
+    pdf = PDF(file_path, memory_budget)
+    document_id = pdf.get_document_id()
+
+    state = get_file_state(file_path)
+    process_document(document, workspace, auto_pages, workers, use_cache, ordered, memory_budget, pdf, database)
+    fingerprints = {page_no: pdf.get_highlight_fingerprint(page_no) for page_no in get_pages(pdf, document, auto_pages)}
+
+    logging.info(f"Watching '{file_path}' for new highlights, press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(interval)
+            new_state = get_file_state(file_path)
+            if new_state is None or new_state == state:
+                continue
+
+            # The reader may still be saving the file, wait until it doesn't change
+            time.sleep(interval / 4)
+            if get_file_state(file_path) != new_state:
+                continue
+            state = new_state
+
+            start = time.perf_counter()
+            try:
+                pdf.reopen()
+            except Exception as error:
+                logging.warning(f"'{file_path}' can't be opened, trying again on the next change: {error}")
+                continue
+
+            # Another document was saved with the same name, nothing of the old one is valid
+            if pdf.get_document_id() != document_id:
+                pdf.doc.close()
+                pdf = PDF(file_path, memory_budget)
+                document_id = pdf.get_document_id()
+                fingerprints = {}
+
+            pages = get_pages(pdf, document, auto_pages)
+            new_fingerprints = {page_no: pdf.get_highlight_fingerprint(page_no) for page_no in pages}
+            changed = [
+                page_no for page_no in pages
+                if new_fingerprints[page_no] is not None and new_fingerprints[page_no] != fingerprints.get(page_no)
+            ]
+            removed = [
+                page_no for page_no, fingerprint in fingerprints.items()
+                if fingerprint is not None and new_fingerprints.get(page_no) is None
+            ]
+            fingerprints = new_fingerprints
+
+            if removed:
+                logging.info(f"Highlights removed from pages {removed}, their notes are kept")
+            if not changed:
+                continue
+
+            cache = ExtractionCache(bookname / CACHE_FILE, document_id) if use_cache else None
+            store = HighlightStore(database) if database is not None else None
+            try:
+                page_texts = extract_pages(pdf, changed, cache=cache)
+                if store is not None:
+                    page_texts = store_pages(page_texts, store, pdf, file_path.stem)
+                written, _ = write_pages(page_texts, bookname, replace=True, page_files=find_page_files(bookname))
+            finally:
+                if cache is not None:
+                    cache.save()
+                if store is not None:
+                    store.close()
+            logging.info(
+                f"Updated {written} of the changed pages {changed} in {time.perf_counter() - start:.2f}s"
+            )
+    except KeyboardInterrupt:
+        logging.info(f"Stopped watching '{file_path}'")
+
+def _init_library_worker(profile: bool):
+    if profile:
+        profiler.enable()
+
+def _process_document_worker(*args, **kwargs) -> dict:
+    """Process a document in a worker process, the summary includes what its profiler recorded"""
+    summary = process_document(*args, **kwargs)
+    summary["profile"] = profiler.get_profiler().take()
+    return summary
+
+def process_library(
+        documents: list[dict],
+        workspace: Path,
+        auto_pages: bool,
+        workers: int,
+        use_cache: bool = True,
+        ordered: bool = False,
+        memory_budget: Optional[int] = None,
+        database: Optional[Path] = None
+    ) -> list[dict]:
+    """
+    Process every PDF in its own process, errors of a PDF don't stop the others.
+
+    PDFs with the same name would write the same folder of the workspace, only the
+    first one is processed and the others fail.
+
+    Returns:
+        The summary of every PDF in the same order of documents, failed PDFs have an "error".
+    """
+    summaries: list[dict] = [{} for _ in documents]
+
+    def report(index: int, summary: dict):
+        summaries[index] = summary
+        done = sum(1 for s in summaries if s)
+        if "error" in summary:
+            logging.error(f"[{done}/{len(documents)}] {summary['pdf_path']} failed: {summary['error']}")
+        else:
+            logging.info(
+                f"[{done}/{len(documents)}] {summary['pdf_path']}: {summary['written']} pages written "
+                f"from {summary['pages']} pages in {summary['seconds']}s"
+            )
+
+    def failed(document: dict, error: Exception) -> dict:
+        return {"pdf_path": str(document["pdf_path"]), "error": f"{type(error).__name__}: {error}"}
+
+    names: dict[str, Path] = {}
+    pending = []
+    for index, document in enumerate(documents):
+        path = document["pdf_path"]
+        first = names.setdefault(path.stem, path)
+        if first == path:
+            pending.append(index)
+        else:
+            report(index, failed(document, ValueError(
+                f"Same name as '{first}', both would write the folder '{path.stem}' of the workspace"
+            )))
+
+    if workers <= 1:
+        for index in pending:
+            document = documents[index]
+            try:
+                report(index, process_document(
+                    document, workspace, auto_pages, use_cache=use_cache, ordered=ordered,
+                    memory_budget=memory_budget, database=database
+                ))
+            except Exception as error:
+                report(index, failed(document, error))
+        return summaries
+
+    profile = profiler.get_profiler().enabled
+    with ProcessPoolExecutor(
+            max_workers=max(1, min(workers, len(pending))),
+            initializer=_init_library_worker,
+            initargs=(profile,)
+        ) as executor:
+        futures = {
+            executor.submit(
+                _process_document_worker, documents[index], workspace, auto_pages,
+                use_cache=use_cache, ordered=ordered, memory_budget=memory_budget, database=database
+            ): index
+            for index in pending
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                summary = future.result()
+                profiler.get_profiler().merge(summary.pop("profile"))
+                report(index, summary)
+            except Exception as error:
+                report(index, failed(documents[index], error))
+    return summaries
+
+def log_peak_memory():
+    peak = peak_rss()
+    if peak is not None:
+        logging.info(f"Peak memory: {peak / (1024 * 1024):.1f} MB")
+
+def save_profile(path: Optional[str]):
+    """Save the summary of the profiler when it is enabled"""
+    run_profiler = profiler.get_profiler()
+    if path is None or not run_profiler.enabled:
+        return
+
+    summary = run_profiler.save(Path(path))
+    logging.info(f"Profile saved in '{path}': {summary['pages']} pages, {summary['pages_per_second']} pages/sec")
+
+def search_highlights(database: Path, query: str, limit: int = 20, book: Optional[str] = None) -> int:
+    """Print the pages of the store matching the query, returns the number of pages found"""
+    with HighlightStore(database) as store:
+        results = store.search(query, limit, book)
+
+    for result in results:
+        titles = " > ".join(title for _, title in result.headers)
+        print(f"{result.book} | page {result.page_no} | {titles}")
+        print(f"    {' '.join(result.snippet.split())}")
+    return len(results)
+
 def main():
     parser = argparse.ArgumentParser(description="Process PDF highlighted text and generate markdown file")
     parser.add_argument("--config", help="JSON configuration file path", default="config.json")
+    parser.add_argument(
+        "--pdf",
+        action="append",
+        dest="pdf_paths",
+        help="PDF path or glob to process instead of the ones in the config, can be repeated"
+    )
+    parser.add_argument(
+        "--auto-pages",
+        action="store_true",
+        help="Process only the pages with highlights, page_start and page_end are ignored"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Extract every page again instead of reusing the pages whose highlights didn't change"
+    )
+    parser.add_argument(
+        "--ordered",
+        action="store_true",
+        help="Insert the pages in the markdown files by page number instead of appending them"
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=None,
+        help="Megabytes each process should use at most, the document is reopened to free memory"
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="profile.json",
+        default=None,
+        help="Record the time of every stage and the size of every page, the summary is saved in this JSON file"
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and update the notes of the pages whose highlights change when the PDF is saved"
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=1.0,
+        help="Seconds between two checks of the PDF in watch mode"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes used to extract the pages, or the PDFs when there are many"
+    )
+    parser.add_argument(
+        "--database",
+        default=None,
+        help="SQLite database where the highlights are also stored to search them"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    search_parser = subparsers.add_parser("search", help="Search the highlights stored in the database")
+    search_parser.add_argument("query", help="FTS5 query, e.g. 'productivity', '\"next action\"' or 'headers:habit*'")
+    search_parser.add_argument("--limit", type=int, default=20, help="Maximum number of pages shown")
+    search_parser.add_argument("--book", default=None, help="Only search the highlights of this book, the PDF name")
     args = parser.parse_args()
+
+    if args.command == "search":
+        database = args.database or load_config(args.config).get("database")
+        if not database or not Path(database).expanduser().exists():
+            parser.error("search needs an existing database, use --database or the \"database\" of the config")
+        try:
+            found = search_highlights(Path(database).expanduser(), args.query, args.limit, args.book)
+        except sqlite3.OperationalError as error:
+            parser.error(f"invalid query '{args.query}': {error}")
+        logging.info(f"{found} pages found")
+        return
+
     config = load_config(args.config)
 
-    file_path = Path(config["pdf_path"]).expanduser()
-    pdf = PDF(file_path)
     workspace = Path(config["markdown_workspace"]).expanduser()
-    page_start, page_end = int(config["page_start"]), int(config["page_end"])
-    bookname = workspace / file_path.stem
+    workers = args.workers or int(config.get("workers", 1))
+    documents = get_documents(config, args.pdf_paths)
+    use_cache = not args.no_cache and config.get("cache", True)
+    ordered = args.ordered or config.get("ordered", False)
+    memory_budget_mb = args.memory_budget or config.get("memory_budget")
+    memory_budget = int(memory_budget_mb) * 1024 * 1024 if memory_budget_mb else None
+    database_path = args.database or config.get("database")
+    database = Path(database_path).expanduser() if database_path else None
+    if args.profile:
+        profiler.enable()
 
-    last_file = ""
+    if args.watch:
+        if len(documents) != 1:
+            parser.error("--watch needs exactly one PDF")
+        watch_document(
+            documents[0], workspace, args.auto_pages, workers, use_cache, ordered, memory_budget, args.interval,
+            database
+        )
+        save_profile(args.profile)
+        log_peak_memory()
+        return
 
-    create_folder(bookname)
-    for page_no in range(page_start, page_end):
-        pdf.setup_page(page_no)
-        pdf.get_headers()
-
-        headers_per_page = pdf.get_headers_for_page()
-        text = pdf.plain_text_to_markdown()
-
-        if not text:
-            logging.info(f"No text to process on page {page_no}. Skipping.")
-            continue
-
-        # As long as the page have headers, create the corresponding md file
-        # otherwise use the last md file.
-        if headers_per_page:
-            subfolder = (bookname / headers_per_page[0][1]).expanduser()
-            file = (subfolder / f"{headers_per_page[1][1]}.md").expanduser()
-            last_file = file
-            create_folder(subfolder)
-
-        write_file(last_file, text, page_no)
+    # Only one PDF, its pages are split between the workers
+    if len(documents) == 1:
+        process_document(
+            documents[0], workspace, args.auto_pages, workers, use_cache, ordered, memory_budget, database=database
+        )
+        save_profile(args.profile)
+        log_peak_memory()
+        return
+
+    summaries = process_library(
+        documents, workspace, args.auto_pages, workers, use_cache, ordered, memory_budget, database
+    )
+    failures = [s for s in summaries if "error" in s]
+    logging.info(
+        f"Processed {len(summaries) - len(failures)} of {len(summaries)} PDFs, "
+        f"{sum(s.get('written', 0) for s in summaries)} pages written"
+    )
+    for summary in failures:
+        logging.error(f"{summary['pdf_path']}: {summary['error']}")
+    save_profile(args.profile)
+    log_peak_memory()
+
+    if failures:
+        raise SystemExit(1)
 
 if __name__ == "__main__":
     main()
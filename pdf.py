@@ -1,11 +1,28 @@
-from typing import Final, Optional, Any
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Final, Iterator, NamedTuple, Optional, Any
 
-import unicodedata
+import hashlib
 import re
 
 import pymupdf
 import numpy as np
 
+from fonts import FontProfile
+from memory import current_rss
+from profiler import Profiler, get_profiler
+from spatial import WordGrid, intersecting_pairs, quads_to_bboxes, to_bboxes
+from toc import HeaderMatcher, TableOfContents
+from words import MARKUP_BOLD_ITALIC, MARKUP_PARAGRAPH_END, WordStore, apply_markup, sort_words
+
+class PageResult(NamedTuple):
+    """Result of a page, see PDF.iter_pages"""
+    page_no: int
+    text: str
+    # Header hierarchy with the format ((level, title),)
+    headers: tuple[tuple[int, str], ...]
+    highlight_count: int
+
 class PDF:
     """This class represents a PDF highlight extractor given a page"""
 
@@ -17,24 +34,416 @@ class PDF:
     # normal text.
     WORDS_THRESHOLD: Final = 10
 
-    def __init__(self, pdf_path: str):
+    # One text page is used for the words, the blocks and the plain text, it keeps
+    # the ligatures of the dict and text output so the words expand them after.
+    TEXTPAGE_FLAGS: Final = pymupdf.TEXTFLAGS_DICT | pymupdf.TEXT_DEHYPHENATE
+    LIGATURES: Final = str.maketrans({
+        "\ufb00": "ff", "\ufb01": "fi", "\ufb02": "fl", "\ufb03": "ffi",
+        "\ufb04": "ffl", "\ufb05": "st", "\ufb06": "st",
+    })
+
+    # When the highlights cover less than this part of the page height, the words
+    # under them are only searched in a band of the page around them.
+    SPARSE_COVERAGE: Final = 0.3
+    # Points added above and below the highlights to build the band
+    BAND_MARGIN: Final = 40
+
+    # Pages read to build the font profile, spread over the whole document
+    FONT_PROFILE_PAGES: Final = 50
+
+    # With a memory budget, the document is reopened after this number of pages,
+    # or after REOPEN_MIN_PAGES if the process uses more memory than the budget.
+    REOPEN_PAGES: Final = 200
+    REOPEN_MIN_PAGES: Final = 20
+
+    def __init__(self, pdf_path: str, memory_budget: Optional[int] = None, font_profile: Optional[FontProfile] = None):
+        """
+        Args:
+            pdf_path: Path of the PDF
+            memory_budget: Bytes the process should use at most, None for no limit
+            font_profile: Profile already built for this document, by default it is built when needed
+        """
+        self.pdf_path = pdf_path
+        self.memory_budget = memory_budget
+        self.__pages_since_open = 0
+
         self.doc = pymupdf.open(pdf_path)
         self.page: Optional[pymupdf.Page] = None
-        self.words: Optional[list] = None
-        self.data: dict[Any, Any]
+        self.__textpage: Optional[pymupdf.TextPage] = None
+        self.__clip: Optional[pymupdf.Rect] = None
+        self.__clip_ready = False
+        self.__words: Optional[WordStore] = None
+        self.__data: Optional[list[dict[Any, Any]]] = None
+        self.__text: Optional[str] = None
+        self.__last_words: Optional[list[tuple]] = None
+        self.word_grid: Optional[WordGrid] = None
+        self.__table_of_contents: Optional[TableOfContents] = None
+        self.__header_matcher: Optional[HeaderMatcher] = None
+        self.__font_profile = font_profile
 
     def setup_page(self, page_no: int) -> None:
         """Setup the corresponding variables given a page"""
         self.page_no = page_no - 1
         self.page = self.doc[self.page_no]
-        # Ascending y, then x to mantain the read order
-        self.words = self.page.get_text("words", flags=pymupdf.TEXT_DEHYPHENATE, sort=True)
-        self.data = self.page.get_text("dict")["blocks"]
-        self.highlight_words: list[tuple] = []
+        self.__reset_page()
+
+    def release_page(self) -> None:
+        """Free the pymupdf objects and the text of the current page"""
+        self.page = None
+        self.__reset_page()
+
+    def reopen(self) -> None:
+        """Close the document and open it again, freeing everything MuPDF has of it"""
+        self.release_page()
+        self.doc.close()
+        pymupdf.TOOLS.store_shrink(100)
+        self.doc = pymupdf.open(self.pdf_path)
+        self.__pages_since_open = 0
+
+    @contextmanager
+    def __low_memory(self) -> Iterator[None]:
+        """
+        With a memory budget, don't keep the display lists of the pages in the MuPDF
+        store while the block runs. It is a setting of the whole process, the previous
+        value is restored after.
+        """
+        if self.memory_budget is None:
+            yield
+            return
+
+        previous = pymupdf.TOOLS.set_low_memory()
+        pymupdf.TOOLS.set_low_memory(True)
+        try:
+            yield
+        finally:
+            pymupdf.TOOLS.set_low_memory(previous)
+
+    def __check_memory(self) -> None:
+        """Free the MuPDF store when the process uses more memory than the budget"""
+        if self.memory_budget is None:
+            return
+
+        self.__pages_since_open += 1
+        if self.__pages_since_open >= self.REOPEN_PAGES:
+            self.reopen()
+            return
+
+        rss = current_rss()
+        if rss is not None and rss > self.memory_budget:
+            pymupdf.TOOLS.store_shrink(100)
+            if self.__pages_since_open >= self.REOPEN_MIN_PAGES:
+                self.reopen()
+
+    def __reset_page(self) -> None:
+        # The text of the page is parsed the first time it is used, see textpage.
+        self.__textpage = None
+        self.__clip = None
+        self.__clip_ready = False
+        self.__words = None
+        self.__data = None
+        self.__text = None
+        self.__last_words = None
+        # Built on demand, only pages with highlights need it
+        self.word_grid = None
+        # Indices in words of the highlighted words sorted by y and then x, see highlight_words
+        self.highlight_indices: list[int] = []
+        self.__highlight_words: Optional[list[tuple]] = None
+        self.quad_count = 0
         self.headers: list[tuple] = []
         self.bold_italic_text: list[tuple] = []
+        # For each highlighted word, True if it touches bold/italic text
+        self.bold_italic_words: Optional[list[bool]] = None
         self.headers_per_page: list[tuple[Any, ...]] = []
 
+    @property
+    def clip(self) -> Optional[pymupdf.Rect]:
+        """
+        Band of the page with the highlights when they cover a small part of the page.
+
+        It has the whole width of the page and BAND_MARGIN above and below the
+        highlights, None when they are searched in the whole page. The page is
+        always parsed entirely, the paragraphs and the headers need all its text.
+        """
+        if not self.__clip_ready and self.page is not None:
+            self.__clip = self.__get_highlight_band()
+            self.__clip_ready = True
+        return self.__clip
+
+    def __get_highlight_band(self) -> Optional[pymupdf.Rect]:
+        if self.page.rotation:
+            return None
+
+        quads = [quads_to_bboxes(annot.vertices) for annot in self.page.annots(types=[pymupdf.PDF_ANNOT_HIGHLIGHT])]
+        quads = [bboxes for bboxes in quads if len(bboxes)]
+        if not quads:
+            return None
+
+        bboxes = np.vstack(quads)
+        page_rect = self.page.rect
+        y0 = max(float(bboxes[:, 1].min()) - self.BAND_MARGIN, page_rect.y0)
+        y1 = min(float(bboxes[:, 3].max()) + self.BAND_MARGIN, page_rect.y1)
+        if y1 - y0 >= self.SPARSE_COVERAGE * page_rect.height:
+            return None
+        return pymupdf.Rect(page_rect.x0, y0, page_rect.x1, y1)
+
+    @property
+    def textpage(self) -> Optional[pymupdf.TextPage]:
+        """Parsed text of the page, words, data and text are taken from it"""
+        if self.__textpage is None and self.page is not None:
+            self.__textpage = self.page.get_textpage(flags=self.TEXTPAGE_FLAGS)
+        return self.__textpage
+
+    @property
+    def words(self) -> Optional[WordStore]:
+        """Words of the page [(x0,y0, x1,y1, "text", block_no, line_no, word_no)]"""
+        if self.__words is None and self.page is not None:
+            # Ascending y, then x to mantain the read order
+            self.__words = WordStore(sort_words(self.textpage.extractWORDS()))
+            texts = self.__words.texts
+            for index, text in enumerate(texts):
+                if not text.isascii():
+                    texts[index] = text.translate(self.LIGATURES)
+        return self.__words
+
+    @words.setter
+    def words(self, value: Optional[list]) -> None:
+        self.__words = value if value is None or isinstance(value, WordStore) else WordStore(value)
+        self.__last_words = None
+
+    @property
+    def highlight_words(self) -> list[tuple]:
+        """
+        Highlighted words [(x0,y0, x1,y1, "text", block_no, line_no, word_no)], the
+        tuples are built from highlight_indices only when the words are formatted.
+        """
+        if self.__highlight_words is None:
+            self.__highlight_words = [self.words[i] for i in self.highlight_indices]
+        return self.__highlight_words
+
+    @highlight_words.setter
+    def highlight_words(self, value: list[tuple]) -> None:
+        self.__highlight_words = value
+
+    def __highlight_count(self) -> int:
+        if self.__highlight_words is None:
+            return len(self.highlight_indices)
+        return len(self.__highlight_words)
+
+    def __highlight_bboxes(self) -> np.ndarray:
+        """Coordinates of the highlighted words as a Nx4 array, without building their tuples"""
+        if self.__highlight_words is None:
+            return self.words.bboxes[self.highlight_indices] if self.highlight_indices else np.empty((0, 4))
+        return to_bboxes(self.__highlight_words)
+
+    @property
+    def data(self) -> list[dict[Any, Any]]:
+        """Blocks of the page with its lines and spans"""
+        if self.__data is None and self.page is not None:
+            self.__data = self.page.get_text("dict", textpage=self.textpage)["blocks"]
+        return self.__data or []
+
+    @data.setter
+    def data(self, value: list[dict[Any, Any]]) -> None:
+        self.__data = value
+
+    @property
+    def text(self) -> str:
+        """Plain text of the page"""
+        if self.__text is None and self.page is not None:
+            self.__text = self.page.get_text("text", textpage=self.textpage)
+        return self.__text or ""
+
+    @property
+    def table_of_contents(self) -> TableOfContents:
+        """Table of contents of the document, it is read only once"""
+        if self.__table_of_contents is None:
+            self.__table_of_contents = TableOfContents(self.doc.get_toc())
+        return self.__table_of_contents
+
+    @property
+    def header_matcher(self) -> HeaderMatcher:
+        """Matcher between the headers found in the pages and the table of contents"""
+        if self.__header_matcher is None:
+            self.__header_matcher = HeaderMatcher(self.table_of_contents)
+        return self.__header_matcher
+
+    @property
+    def font_profile(self) -> FontProfile:
+        """Font sizes of the document, used to find the headers of every page"""
+        if self.__font_profile is None:
+            self.__font_profile = self.__build_font_profile()
+        return self.__font_profile
+
+    def __build_font_profile(self) -> FontProfile:
+        """Read the spans of up to FONT_PROFILE_PAGES pages spread over the document"""
+        profile = FontProfile()
+        page_count = self.doc.page_count
+        if page_count <= self.FONT_PROFILE_PAGES:
+            page_indices = range(page_count)
+        else:
+            step = (page_count - 1) / (self.FONT_PROFILE_PAGES - 1)
+            page_indices = sorted({round(i * step) for i in range(self.FONT_PROFILE_PAGES)})
+
+        # The images are not needed, only the sizes of the spans
+        flags = pymupdf.TEXTFLAGS_DICT & ~pymupdf.TEXT_PRESERVE_IMAGES
+        for page_index in page_indices:
+            for block in self.doc[page_index].get_text("dict", flags=flags)["blocks"]:
+                if block["type"] == pymupdf.PDF_ANNOT_TEXT:
+                    for line in block["lines"]:
+                        for span in line["spans"]:
+                            profile.add_span(span)
+        return profile
+
+    def get_highlighted_pages(self) -> list[int]:
+        """
+        Get the pages that have highlight annotations in one pass over the document.
+
+        The annotations are read from the /Annots array of every page object,
+        this avoids loading the pages.
+
+        Returns:
+            The page numbers starting from 1, in ascending order.
+        """
+        return [
+            page_index + 1
+            for page_index in range(self.doc.page_count)
+            if self.__get_highlight_annotations(page_index)
+        ]
+
+    def get_highlight_fingerprint(self, page_no: int) -> Optional[str]:
+        """
+        Get a fingerprint of the highlights of a page without loading it.
+
+        It changes when a highlight is added, removed or modified.
+
+        Returns:
+            A hash of the xref, rect, quads and modification date of every highlight,
+            None if the page doesn't have highlights.
+        """
+        annotations = self.__get_highlight_annotations(page_no - 1)
+        if not annotations:
+            return None
+        return hashlib.sha1(repr(annotations).encode()).hexdigest()
+
+    def get_highlight_bboxes(self, page_no: int) -> list[list[float]]:
+        """Get the rectangle of every line of the highlights of a page [[x0,y0, x1,y1]]"""
+        page = self.doc[page_no - 1]
+        return [
+            [round(value, 2) for value in bbox]
+            for annot in page.annots(types=[pymupdf.PDF_ANNOT_HIGHLIGHT])
+            for bbox in quads_to_bboxes(annot.vertices).tolist()
+        ]
+
+    def get_document_id(self) -> str:
+        """Get an id of the document that doesn't change when annotations are added"""
+        # The first element of the trailer /ID is permanent, the second changes with every update
+        kind, value = self.doc.xref_get_key(-1, "ID") if self.doc.is_pdf else ("null", "null")
+        ids = re.findall(r"<([0-9A-Fa-f]*)>", value) if kind == "array" else []
+        if ids and ids[0]:
+            return ids[0].lower()
+
+        metadata = self.doc.metadata or {}
+        identity = (self.doc.page_count, metadata.get("title"), metadata.get("creationDate"))
+        return hashlib.sha1(repr(identity).encode()).hexdigest()
+
+    def __get_highlight_annotations(self, page_index: int) -> list[tuple]:
+        """
+        Get the highlights of the page reading the /Annots array of the page object.
+
+        Returns:
+            A list with format [(xref, rect, quad_points, modification_date)]
+        """
+        if not self.doc.is_pdf:
+            return []
+
+        page_xref = self.doc.page_xref(page_index)
+        kind, annots = self.doc.xref_get_key(page_xref, "Annots")
+        if kind == "xref":
+            # The array is an indirect object
+            annots = self.doc.xref_object(int(annots.split()[0]), compressed=True)
+        elif kind != "array":
+            return []
+
+        # Annotations defined directly inside the array don't have an xref,
+        # load the page for those uncommon cases.
+        if "<<" in annots:
+            page = self.doc[page_index]
+            return [
+                (annot.xref, tuple(annot.rect), annot.vertices, annot.info.get("modDate"))
+                for annot in page.annots(types=[pymupdf.PDF_ANNOT_HIGHLIGHT])
+            ]
+
+        highlights = []
+        for xref in map(int, re.findall(r"(\d+) \d+ R", annots)):
+            if self.doc.xref_get_key(xref, "Subtype")[1] == "/Highlight":
+                highlights.append((
+                    xref,
+                    self.doc.xref_get_key(xref, "Rect")[1],
+                    self.doc.xref_get_key(xref, "QuadPoints")[1],
+                    self.doc.xref_get_key(xref, "M")[1],
+                ))
+        return highlights
+
+    def extract_page(self, page_no: int) -> PageResult:
+        """
+        Get the markdown text and the header hierarchy of a page, the page is released after.
+
+        Pages without highlights are not loaded, their text is empty.
+        """
+        highlight_count = len(self.__get_highlight_annotations(page_no - 1))
+        if not highlight_count:
+            return PageResult(page_no, "", (), 0)
+
+        profiler = get_profiler()
+        with self.__low_memory():
+            self.setup_page(page_no)
+            try:
+                with profiler.stage("setup_page"):
+                    # The text is parsed here, the next stages only use it
+                    self.words, self.data, self.text
+                with profiler.stage("headers"):
+                    self.__extract_headers()
+                with profiler.stage("toc"):
+                    headers = tuple(self.get_headers_for_page())
+                with profiler.stage("highlights"):
+                    self.__extract_highlight_text()
+                with profiler.stage("bold_italic"):
+                    self.__extract_bold_italic_text()
+                if profiler.enabled:
+                    self.__count_page(profiler, highlight_count)
+                with profiler.stage("formatting"):
+                    text = self.plain_text_to_markdown()
+            finally:
+                self.release_page()
+                self.__check_memory()
+        profiler.page_done()
+        return PageResult(page_no, text, headers, highlight_count)
+
+    def __count_page(self, profiler: Profiler, highlight_count: int) -> None:
+        """Record the size of the current page"""
+        profiler.count("words", len(self.words or []))
+        profiler.count("sparse", int(self.clip is not None))
+        profiler.count("spans", sum(len(line["spans"]) for block in self.data for line in block.get("lines", [])))
+        profiler.count("highlights", highlight_count)
+        profiler.count("quads", self.quad_count)
+        profiler.count("headers", len(self.headers))
+        profiler.count("highlighted_words", self.__highlight_count())
+
+    def iter_pages(self, start: int = 1, end: Optional[int] = None) -> Iterator[PageResult]:
+        """
+        Extract the pages one by one, only the current page is kept in memory.
+
+        Args:
+            start: First page, starting from 1
+            end: Page where to stop, it is not included. By default after the last page
+
+        Yields:
+            A PageResult for every page in ascending order.
+        """
+        end = self.doc.page_count + 1 if end is None else end
+        for page_no in range(start, end):
+            yield self.extract_page(page_no)
+
     def get_highlight_text(self) -> list[str]:
         """Get all highlight text from the pdf"""
         self.__extract_highlight_text()
@@ -52,36 +461,13 @@ class PDF:
 
     def get_entire_text(self) -> list[str]:
         """Combine headers and highlight text and return it as a formated text"""
-        if not self.highlight_words:
+        if not self.__highlight_count():
             self.__extract_highlight_text()
 
         if not self.headers:
             self.__extract_headers()
 
-        final_text = []
-        used_headers = set()
-        for word in self.highlight_words:
-            word_y = word[3]
-
-            if self.headers:
-                for header_index, header in enumerate(self.headers):
-                    # Get the ranges between headers
-                    header_y1 = self.headers[header_index][3]
-                    # Avoid to get the last header
-                    header_y2 = self.headers[header_index + 1][3] \
-                        if header_index + 1 < len(self.headers) \
-                        else float("inf")
-
-                    # Insert the header if our highlight text corresponds to that header by
-                    # checking the range between headers.
-                    if header_index not in used_headers and header_y1 < word_y < header_y2:
-                        new_value = "\n\n\n" + header[-1] + "\n\n\n"
-                        final_text.append(header[:4] + (new_value,))
-                        used_headers.add(header_index)
-                        break
-
-            final_text.append(word)
-
+        final_text, _ = self.__insert_headers(self.highlight_words)
         return self.__format_text(final_text)
         # return "".join(self.__format_text(final_text))
 
@@ -95,18 +481,14 @@ class PDF:
             The root title of the header or and empty string if there is not a table
             of content by the PDF file.
         """
-        table_of_content = self.doc.get_toc()
+        table_of_content = self.table_of_contents
 
         if not self.headers:
             self.__extract_headers()
 
         if not table_of_content:
             return []
-        level_titles = [
-            (current_level, title)
-            for current_level, title, page in table_of_content
-            if page <= self.page_no + 1
-        ]
+        toc_indices = table_of_content.indices_up_to(self.page_no + 1)
 
         dummy_header = False
         # If the page doesn't have any headers, just add the last header found
@@ -114,31 +496,28 @@ class PDF:
         if not self.headers:
             dummy_header = True
             # Just add dummy info for the coordinates, we only care the text
-            self.headers.append((0,0,0,0,level_titles[-1][1]))
+            self.headers.append((0,0,0,0,table_of_content.entries[toc_indices[-1]][1]))
 
-        pattern = r"[^\w\s.]"
-        levels_to_add = set()
-        for level, header in reversed(level_titles):
-            header_clean = re.sub(pattern, "", header).strip()
-            header_normalized_clean = unicodedata.normalize("NFKD", header_clean)
+        # Titles of the table of contents that contain a header of the page,
+        # normalized with unicode to remove ligatures.
+        matched_titles: set[int] = set()
+        for h in self.headers:
+            matched_titles.update(self.header_matcher.titles_containing(h[4]))
+        first_matched = min(matched_titles, default=len(table_of_content))
 
-            for h in self.headers:
-                h_clean = re.sub(pattern, "", h[4]).strip()
-                h_normalized_clean = unicodedata.normalize("NFKD", h_clean)
-
-                # Unicode to remove ligatures
-                # if h_normalized_clean == header_normalized_clean:
-                if h_normalized_clean in header_normalized_clean:
-                    self.headers_per_page.append((level, header))
-                    # For this header, save the father level that should be saved
-                    levels_to_add.add(level - 1)
-                    levels_to_add.discard(level)
-
-                # Save the level father
-                if level in levels_to_add:
-                    self.headers_per_page.append((level, header))
-                    levels_to_add.add(level - 1)
-                    levels_to_add.discard(level)
+        levels_to_add = set()
+        for index in reversed(toc_indices):
+            # Nothing else to add when all the fathers were found
+            if index < first_matched and all(l < table_of_content.min_level for l in levels_to_add):
+                break
+
+            level, header, _ = table_of_content.entries[index]
+            # Save the header, or the level father of a header already saved
+            if index in matched_titles or level in levels_to_add:
+                self.headers_per_page.append((level, header))
+                # For this header, save the father level that should be saved
+                levels_to_add.add(level - 1)
+                levels_to_add.discard(level)
 
         # Remove the dummy header when the page doesn't have any headers
         if dummy_header:
@@ -156,7 +535,7 @@ class PDF:
 
     def plain_text_to_markdown(self) -> str:
         """Converts a plain text to markdown formt for headers and bold/italic"""
-        if not self.highlight_words:
+        if not self.__highlight_count():
             self.__extract_highlight_text()
 
         if not self.bold_italic_text:
@@ -168,82 +547,82 @@ class PDF:
         if not self.headers:
             self.__extract_headers()
 
-        pattern = r"[^\w\s.]"
         # Lets format the headers according to its level
         for level, header in self.headers_per_page:
-            header_clean = re.sub(pattern, "", header).strip()
-            normalized_header_clean = unicodedata.normalize("NFKD", header_clean)
             for i, h in enumerate(self.headers):
-                h_clean = re.sub(pattern, "", h[4]).strip()
-                normalized_h_clean = unicodedata.normalize("NFKD", h_clean)
                 # Unicode to remove ligatures
-                # if normalized_h_clean == normalized_header_clean:
-                if normalized_h_clean in normalized_header_clean:
+                if self.header_matcher.is_part_of(h[4], header):
                     self.headers[i] = h[:4] + (f"{'#' * (level)} {h[4]}",)
 
         # Clean headers
         temp_headers = [header for header in self.headers if "#" in header[4]]
         self.headers = temp_headers
 
-        used_headers = set()
-        final_text = []
-        for word in self.highlight_words:
-            word_y = word[3]
-            word_rect = pymupdf.Rect(word[:4])
-
-            for bold_italic_word in self.bold_italic_text:
-                bold_italic_rect = pymupdf.Rect(bold_italic_word[:4])
+        # For each highlighted word, True if it touches any bold/italic text. They are
+        # found with the bold/italic text unless it was set without extracting it.
+        bold_italic_words = self.bold_italic_words
+        if bold_italic_words is None or len(bold_italic_words) != self.__highlight_count():
+            bold_italic_words = [
+                bool(spans)
+                for spans in intersecting_pairs(self.__highlight_bboxes(), to_bboxes(self.bold_italic_text))
+            ]
 
-                if word_rect.intersects(bold_italic_rect):
-                    word = word[:4] + (f"**_{word[4]}_**",)
-                    break
+        # The words are not copied, the markup is applied when they are formatted
+        markup = [MARKUP_BOLD_ITALIC if is_bold_italic else 0 for is_bold_italic in bold_italic_words]
+        final_text, markup = self.__insert_headers(self.highlight_words, markup)
 
-            if self.headers:
-                for header_index, header in enumerate(self.headers):
-                    # Get the ranges between headers
-                    current_header_y1 = self.headers[header_index][3]
-                    # Avoid to get the last header
-                    next_header_y2 = self.headers[header_index + 1][3] \
-                        if header_index + 1 < len(self.headers) \
-                        else float("inf")
-
-                    # Insert the header if our highlight text corresponds to that header by
-                    # checking the range between headers.
-                    if header_index not in used_headers and current_header_y1 < word_y < next_header_y2:
-                        new_value = "\n\n\n" + header[-1] + "\n\n\n"
-                        final_text.append(header[:4] + (new_value,))
-                        used_headers.add(header_index)
-                        break
+        return "".join(self.__format_text(final_text, markup))
 
-            final_text.append(word)
-
-        return "".join(self.__format_text(final_text))
-
-    def __adjust_rectangle(self, rect, margin=1.0):
-        return pymupdf.Rect(
-            rect.x0,
-            rect.y0 + margin, # y inferior
-            rect.x1,
-            rect.y1 - margin  # y superior
-        )
-
-    def __calculate_dynamic_threshold(self, font_sizes: list[float]) -> np.float64:
-        """ Calculate a dynamic threshold based on font size distribution. """
-        threshold:np.float64 = 0.0
-        if font_sizes:
-            median_size = np.median(font_sizes)
-            std_dev = np.std(font_sizes)
-            threshold = median_size + std_dev
-        return threshold
-
-    def __get_common_font_size(self) -> list[float]:
-        font_size = []
+    def __get_section(
+            self,
+            header_ys: list[float],
+            is_sorted: bool,
+            word_y: float,
+            used_headers: set[int]
+        ) -> Optional[int]:
+        """Get the index of the unused header whose range (header_y, next_header_y) has the word, None if any"""
+        if is_sorted:
+            # Sorted headers don't overlap, the only range is the one of the last header above the word
+            index = bisect_left(header_ys, word_y)
+            if index and (index == len(header_ys) or word_y < header_ys[index]) and index - 1 not in used_headers:
+                return index - 1
+            return None
+
+        # Otherwise the first range not used yet
+        for header_index, header_y1 in enumerate(header_ys):
+            header_y2 = header_ys[header_index + 1] if header_index + 1 < len(header_ys) else float("inf")
+            if header_index not in used_headers and header_y1 < word_y < header_y2:
+                return header_index
+        return None
+
+    def __insert_headers(
+            self,
+            words: list[tuple],
+            markup: Optional[list[int]] = None
+        ) -> tuple[list[tuple], list[int]]:
+        """
+        Insert every header before the first word of its range, the range goes until the next header.
 
-        def collect_font_size(span):
-            font_size.append(span["size"])
+        Returns:
+            The words with the headers, and the markup of every one of them.
+        """
+        header_ys = [header[3] for header in self.headers]
+        is_sorted = all(y1 <= y2 for y1, y2 in zip(header_ys, header_ys[1:]))
+        used_headers: set[int] = set()
+        final_text = []
+        final_markup = []
+        for i, word in enumerate(words):
+            header_index = self.__get_section(header_ys, is_sorted, word[3], used_headers)
+            if header_index is not None:
+                header = self.headers[header_index]
+                new_value = "\n\n\n" + header[-1] + "\n\n\n"
+                final_text.append(header[:4] + (new_value,))
+                final_markup.append(0)
+                used_headers.add(header_index)
 
-        self.__process_text_blocks(collect_font_size)
-        return font_size
+            final_text.append(word)
+            final_markup.append(markup[i] if markup else 0)
+        return final_text, final_markup
 
     def __extract_bold_italic_text(self) -> list[tuple]:
         bold_italic_text = []
@@ -256,15 +635,18 @@ class PDF:
         self.__process_text_blocks(collect_bold_italic_text)
 
         seen_words = set()
-        if not self.highlight_words:
+        if not self.__highlight_count():
             self.__extract_highlight_text()
 
-        for word in self.highlight_words:
-            word_rect = pymupdf.Rect(word[:4])
-            for bold_italic_word in bold_italic_text:
-                bold_italic_rect = pymupdf.Rect(bold_italic_word[:4])
+        # The bold/italic spans that touch every highlighted word
+        pairs = intersecting_pairs(self.__highlight_bboxes(), to_bboxes(bold_italic_text))
+        # A word touching any span always has one of them in bold_italic_text
+        self.bold_italic_words = [bool(spans) for spans in pairs]
+        for spans in pairs:
+            for span_index in spans:
+                bold_italic_word = bold_italic_text[span_index]
 
-                if bold_italic_word not in seen_words and bold_italic_rect.intersects(word_rect):
+                if bold_italic_word not in seen_words:
                     new_word = bold_italic_word[:4] + (bold_italic_word[4].strip(),)
                     self.bold_italic_text.append(new_word)
                     seen_words.add(bold_italic_word)
@@ -285,28 +667,33 @@ class PDF:
         Returns:
             A list with format [(x0, y0, x1, y1, word, block_no, line_no, word_no)]"""
         # Find all the words that are at the end of the line with a ".",
-        # save it as (word_index, word)
-
+        # they are the same for every call on the page.
         if self.page is None or self.words is None:
             raise ValueError("Page is not setup. Call setup_page first.")
 
-        last_words_block = [
-            (len(line.split()) - 1, line.split()[-2], line.split()[-1])
-            for line in self.page.get_text("text").split("\n")
-            if line.endswith(".") and len(line.split()) > 1
-        ]
+        if self.__last_words is not None:
+            return self.__last_words
+
+        # Save it as (word_index, previous_word, word), every line is split once
+        last_words_block = set()
+        for line in self.text.split("\n"):
+            if line.endswith("."):
+                line_words = line.split()
+                if len(line_words) > 1:
+                    last_words_block.add((len(line_words) - 1, line_words[-2], line_words[-1]))
 
         # Find in our last_words_block its index about where you can find the word it in the pdf
         l = []
-        for i, word in enumerate(self.words):
-            word_number = word[-1]
-            previous_word = self.words[i-1][4]
-            current_word = word[4]
+        texts = self.words.texts
+        previous_word = texts[-1] if texts else None
+        for i, (word_number, current_word) in enumerate(zip(self.words.word_numbers, texts)):
             # We save also the previous word because you can find multiple times the same word.
             # saving its previous word is less likely to find the repeated word
-            w = (word_number, previous_word, current_word)
-            if w in last_words_block:
-                l.append(word)
+            if (word_number, previous_word, current_word) in last_words_block:
+                l.append(self.words[i])
+            previous_word = current_word
+
+        self.__last_words = l
         return l
 
     def __get_indices_for_all_last_words_block(
@@ -338,41 +725,45 @@ class PDF:
             i += 1
         return last_words_seen
 
-    def __sort_text(self, words: list[tuple]) -> list[tuple]:
+    def __sort_text(self, words: list[tuple]) -> list[int]:
         """Sort based on X position every single line of the words
             to make sure the order is correct
+
+        Returns:
+            The indices of the words in the sorted order
         """
-        final_text = []
-        current_line: list[tuple] = []
+        final_order = []
+        current_line: list[int] = []
         previous_y = None
 
         # Sort completelly the words
-        for word in words:
+        for index, word in enumerate(words):
             word_y = word[3]
 
             # Entering the if it means we are in a new line.
             if previous_y is None or abs(word_y - previous_y) > self.VERTICAL_THRESHOLD:
                 if current_line:
                     # Sort by x to preserve the order from left to right
-                    current_line.sort(key=lambda w: w[0])
-                    final_text.extend(current_line)
+                    current_line.sort(key=lambda i: words[i][0])
+                    final_order.extend(current_line)
                     current_line = []
 
             previous_y = word_y
-            current_line.append(word)
+            current_line.append(index)
 
         # Add the last line
         if current_line:
-            current_line.sort(key=lambda w: w[0])
-            final_text.extend(current_line)
+            current_line.sort(key=lambda i: words[i][0])
+            final_order.extend(current_line)
 
-        return final_text
+        return final_order
 
-    def __format_text(self, words: list[tuple]) -> list[str]:
+    def __format_text(self, words: list[tuple], markup: Optional[list[int]] = None) -> list[str]:
         """Format the highlighted text as faithfully as possible like you can find it on the PDF
         
         Args:
             words: Tuple with information [(x0,y0, x1,y1, "text", block_no, line_no, word_no)]
+            markup: Markup of every word as MARKUP_* flags, see words.apply_markup
 
         Returns:
             List of string where each element is a line
@@ -380,10 +771,14 @@ class PDF:
         final_text = []
 
         last_words_block = self.__get_all_last_words_in_block()
-        words = self.__sort_text(words)
+        order = self.__sort_text(words)
+        words = [words[i] for i in order]
+        markup = [markup[i] for i in order] if markup else [0] * len(words)
         last_words_seen = self.__get_indices_for_all_last_words_block(words, last_words_block)
 
-        current_line: list[tuple] = []
+        # Texts of the words of the current line with their markup
+        current_line: list[str] = []
+        header_texts = {header[4] for header in self.headers}
 
         previous_y = None
         for i, word in enumerate(words):
@@ -392,36 +787,36 @@ class PDF:
             # Entering the if it means we are in a new line.
             if previous_y is None or abs(word_y - previous_y) > self.VERTICAL_THRESHOLD:
                 if current_line:
-                    temp_string = " ".join(e[4] for e in current_line)
+                    temp_string = " ".join(current_line)
 
                     # Just add a blank space when the text is continuous
                     if temp_string[-1] != "\n":
                         temp_string = temp_string + " "
 
                     # There are some incorrect words with the "\n\n" on the left, remove "\n\n"
-                    if not any(temp_string.rstrip("\n") == header[4] for header in self.headers):
+                    if temp_string.rstrip("\n") not in header_texts:
                         final_text.append(temp_string.replace("\n\n ", " "))
                     else:
                         final_text.append(temp_string)
                     current_line = []
 
+            word_markup = markup[i]
             if i in last_words_seen:
-                new_value = words[i][4] + "\n\n"
-                word = word[:4] + (new_value,) + word[5:]
+                word_markup |= MARKUP_PARAGRAPH_END
 
             previous_y = word_y
-            current_line.append(word)
+            current_line.append(apply_markup(word[4], word_markup))
 
         # Add the last line
         if current_line:
-            temp_string = " ".join(e[4] for e in current_line)
+            temp_string = " ".join(current_line)
             # Just add a blank space when the text is continuous
             if temp_string[-1] != "\n":
                 temp_string = temp_string + " "
 
             temp_string += "\n\n"
             # There are some incorrect words with the "\n\n" on the left, remove "\n\n"
-            if not any(temp_string.rstrip("\n") == header[4] for header in self.headers):
+            if temp_string.rstrip("\n") not in header_texts:
                 final_text.append(temp_string.replace("\n\n ", " "))
             else:
                 final_text.append(temp_string)
@@ -432,29 +827,45 @@ class PDF:
         return final_text
 
     def __extract_highlight_text(self):
-        self.highlight_words = []
-        seen_words = set()
+        self.highlight_indices = []
+        self.__highlight_words = None
+        self.quad_count = 0
 
         if self.page is None or self.words is None:
             raise ValueError("Page is not setup. Call setup_page first.")
 
+        # Words under any quad, a word under several quads is taken once
+        highlighted = np.zeros(len(self.words), dtype=bool)
+        bboxes = self.words.bboxes
+        # Indices in words of the words in the grid, only the ones of the band on sparse pages
+        grid_indices = np.arange(len(self.words))
+        if self.clip is not None:
+            grid_indices = np.flatnonzero((bboxes[:, 3] > self.clip.y0) & (bboxes[:, 1] < self.clip.y1))
+
         for annot in self.page.annots(types=[pymupdf.PDF_ANNOT_HIGHLIGHT]):
-            quad_coordinates = annot.vertices
-            quad_count = len(quad_coordinates) // 4
-
-            for i in range(quad_count):
-                rect = pymupdf.Quad(quad_coordinates[i * 4 : i * 4 + 4]).rect
-                rect = self.__adjust_rectangle(rect, 2.0)
-                for word in self.words:
-                    # Get (x0,y0), (x1,y1), word
-                    word_key = word[:5]
-                    if pymupdf.Rect(word[:4]).intersects(rect) and word_key not in seen_words:
-                        self.highlight_words.append(word)
-                        # Mark it as seen to avoid repeated words.
-                        seen_words.add(word_key)
+            # Rectangle of every quad, reduced on y to avoid taking the lines above and below
+            quad_rects = quads_to_bboxes(annot.vertices, margin=2.0)
+            self.quad_count += len(quad_rects)
+
+            if self.word_grid is None:
+                self.word_grid = WordGrid(bboxes[grid_indices])
+
+            for rect in quad_rects:
+                highlighted[grid_indices[self.word_grid.query(rect)]] = True
+
+        # Text drawn twice at the same place (overprinted or fake bold) is taken once
+        seen_words = set()
+        indices = []
+        texts = self.words.texts
+        for index in np.flatnonzero(highlighted).tolist():
+            word_key = (*bboxes[index].tolist(), texts[index])
+            if word_key not in seen_words:
+                seen_words.add(word_key)
+                indices.append(index)
 
         # Sort by y and then x to preserve the word order.
-        self.highlight_words.sort(key=lambda w: (w[3], w[0]))
+        records = self.words.records[indices]
+        self.highlight_indices = [indices[i] for i in np.lexsort((records["x0"], records["y1"])).tolist()]
 
     def __extract_headers(self) -> None:
         """
@@ -468,8 +879,8 @@ class PDF:
             None. Updates self.headers with a list of tuples [(x0, y0, x1, y1, text)].
         """
         headers = []
-        font_sizes = self.__get_common_font_size()
-        threshold = self.__calculate_dynamic_threshold(font_sizes)
+        # The same threshold for every page, computed once for the document
+        threshold = self.font_profile.threshold
 
         def collect_headers(span):
             font = span["font"].lower()
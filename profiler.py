@@ -0,0 +1,121 @@
+import json
+import time
+
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Any, ContextManager, Final, Iterator, Optional, Union
+
+import numpy as np
+
+# Percentiles reported for every stage and counter
+PERCENTILES: Final = (50, 90, 99)
+
+class Profiler:
+    """
+    Wall time of the stages and counters of every page.
+
+    Every stage or counter keeps one value per time it is recorded, the summary
+    gives their totals and percentiles.
+    """
+
+    enabled: Final = True
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.pages = 0
+        self.stages: dict[str, list[float]] = {}
+        self.counters: dict[str, list[int]] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.setdefault(name, []).append(time.perf_counter() - start)
+
+    def count(self, name: str, value: int) -> None:
+        self.counters.setdefault(name, []).append(value)
+
+    def page_done(self) -> None:
+        self.pages += 1
+
+    def take(self) -> dict[str, Any]:
+        """Get the values recorded until now and start again, used to send them from a worker process"""
+        records = {"pages": self.pages, "stages": self.stages, "counters": self.counters}
+        self.pages, self.stages, self.counters = 0, {}, {}
+        return records
+
+    def merge(self, records: Optional[dict[str, Any]]) -> None:
+        """Add the values taken from the profiler of another process"""
+        if not records:
+            return
+        self.pages += records["pages"]
+        for name, values in records["stages"].items():
+            self.stages.setdefault(name, []).extend(values)
+        for name, values in records["counters"].items():
+            self.counters.setdefault(name, []).extend(values)
+
+    def summary(self) -> dict[str, Any]:
+        """Get the totals and percentiles of every stage and counter, and the pages per second"""
+        seconds = time.perf_counter() - self.start
+        return {
+            "pages": self.pages,
+            "seconds": round(seconds, 4),
+            "pages_per_second": round(self.pages / seconds, 2) if seconds else None,
+            "stages": {name: self.__describe(values, 6) for name, values in self.stages.items()},
+            "counters": {name: self.__describe(values, 2) for name, values in self.counters.items()},
+        }
+
+    def __describe(self, values: list, digits: int) -> dict[str, Any]:
+        description = {"count": len(values), "total": round(float(np.sum(values)), digits)}
+        for percentile, value in zip(PERCENTILES, np.percentile(values, PERCENTILES).tolist()):
+            description[f"p{percentile}"] = round(value, digits)
+        description["max"] = round(float(np.max(values)), digits)
+        return description
+
+    def save(self, path: Path) -> dict[str, Any]:
+        summary = self.summary()
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(summary, file, indent=4)
+        return summary
+
+class NullProfiler:
+    """Profiler used when profiling is disabled, every method does nothing"""
+
+    enabled: Final = False
+    __stage: Final = nullcontext()
+
+    def stage(self, name: str) -> ContextManager[None]:
+        return self.__stage
+
+    def count(self, name: str, value: int) -> None:
+        pass
+
+    def page_done(self) -> None:
+        pass
+
+    def take(self) -> Optional[dict[str, Any]]:
+        return None
+
+    def merge(self, records: Optional[dict[str, Any]]) -> None:
+        pass
+
+NULL_PROFILER: Final = NullProfiler()
+
+# Profiler of the process, see enable
+_profiler: Union[Profiler, NullProfiler] = NULL_PROFILER
+
+def enable() -> Profiler:
+    """Start recording the stages and counters of this process"""
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+def disable() -> None:
+    """Stop recording, what was recorded is dropped"""
+    global _profiler
+    _profiler = NULL_PROFILER
+
+def get_profiler() -> Union[Profiler, NullProfiler]:
+    return _profiler
@@ -0,0 +1,180 @@
+from collections import defaultdict
+from typing import Final
+
+import numpy as np
+
+from words import WordStore
+
+# Limits used by pymupdf for the infinite rectangle, it never intersects anything.
+INFINITE_MIN: Final = -2147483648
+INFINITE_MAX: Final = 2147483520
+
+def to_bboxes(items: list[tuple]) -> np.ndarray:
+    """Get the coordinates of words, spans or headers as a Nx4 array
+
+    Args:
+        items: Tuples starting with the coordinates [(x0, y0, x1, y1, ...)], or the Nx4 array
+
+    Returns:
+        A float array where each row is (x0, y0, x1, y1)
+    """
+    # The coordinates of a store are already in an array
+    if isinstance(items, WordStore):
+        return items.bboxes
+    if isinstance(items, np.ndarray):
+        return items
+    if not items:
+        return np.empty((0, 4), dtype=np.float64)
+    return np.array([item[:4] for item in items], dtype=np.float64)
+
+def quads_to_bboxes(vertices: list, margin: float = 0.0) -> np.ndarray:
+    """Get the rectangle of each quad given the vertices of an annotation
+
+    Args:
+        vertices: Points [(x, y)] where every 4 points are a quad
+        margin: Value added to y0 and removed from y1 of every rectangle
+
+    Returns:
+        A float array where each row is (x0, y0, x1, y1)
+    """
+    quad_count = len(vertices) // 4
+    if not quad_count:
+        return np.empty((0, 4), dtype=np.float64)
+
+    points = np.array(vertices[:quad_count * 4], dtype=np.float64).reshape(quad_count, 4, 2)
+    bboxes = np.hstack((points.min(axis=1), points.max(axis=1)))
+    bboxes[:, 1] += margin
+    bboxes[:, 3] -= margin
+    return bboxes
+
+def valid_bboxes(bboxes: np.ndarray) -> np.ndarray:
+    """Mask of the rectangles that can intersect, the ones not empty nor infinite"""
+    infinite = (
+        (bboxes[:, 0] == INFINITE_MIN) & (bboxes[:, 1] == INFINITE_MIN)
+        & (bboxes[:, 2] == INFINITE_MAX) & (bboxes[:, 3] == INFINITE_MAX)
+    )
+    return (bboxes[:, 0] < bboxes[:, 2]) & (bboxes[:, 1] < bboxes[:, 3]) & ~infinite
+
+def intersects(bboxes: np.ndarray, bbox: np.ndarray) -> np.ndarray:
+    """Mask of the rectangles that intersect bbox, same rules as pymupdf.Rect.intersects"""
+    if not valid_bboxes(bbox.reshape(1, 4))[0]:
+        return np.zeros(len(bboxes), dtype=bool)
+
+    return (
+        valid_bboxes(bboxes)
+        & (bboxes[:, 0] < bbox[2]) & (bbox[0] < bboxes[:, 2])
+        & (bboxes[:, 1] < bbox[3]) & (bbox[1] < bboxes[:, 3])
+    )
+
+def intersecting_pairs(a: np.ndarray, b: np.ndarray) -> list[list[int]]:
+    """Find the rectangles of b that intersect every rectangle of a with a sweep line over y
+
+    The rectangles are visited by y0, each one is only compared with the rectangles
+    of the other group that are still open, the ones whose y1 is below its y0.
+
+    Returns:
+        For every rectangle of a, the indices of b that intersect it in ascending order,
+        same rules as pymupdf.Rect.intersects
+    """
+    pairs: list[list[int]] = [[] for _ in range(len(a))]
+    if not len(a) or not len(b):
+        return pairs
+
+    boxes = (a.tolist(), b.tolist())
+    # Events as (y0, group, index), empty and infinite rectangles never intersect
+    events = sorted(
+        (boxes[group][index][1], group, index)
+        for group, bboxes in enumerate((a, b))
+        for index in np.flatnonzero(valid_bboxes(bboxes)).tolist()
+    )
+    active: tuple[list[int], list[int]] = ([], [])
+
+    for y0, group, index in events:
+        x0, _, x1, _ = boxes[group][index]
+        others = boxes[1 - group]
+        # Drop the rectangles of the other group that end before this one starts
+        still_open = []
+        for other in active[1 - group]:
+            ox0, _, ox1, oy1 = others[other]
+            if oy1 > y0:
+                still_open.append(other)
+                if ox0 < x1 and x0 < ox1:
+                    if group:
+                        pairs[other].append(index)
+                    else:
+                        pairs[index].append(other)
+        active[1 - group][:] = still_open
+        active[group].append(index)
+
+    for row in pairs:
+        row.sort()
+    return pairs
+
+class WordGrid:
+    """Uniform grid over the word bboxes of a page to find the words under a rectangle"""
+
+    # Cell size as a multiple of the average word size, a cell usually holds
+    # a few words of a couple of lines.
+    CELL_WIDTH_FACTOR: Final = 4
+    CELL_HEIGHT_FACTOR: Final = 2
+
+    def __init__(self, words: list[tuple]):
+        """
+        Args:
+            words: Tuple with information [(x0,y0, x1,y1, "text", block_no, line_no, word_no)]
+        """
+        self.bboxes = to_bboxes(words)
+        self.cells: dict[tuple[int, int], list[int]] = defaultdict(list)
+
+        # Empty rectangles never intersect anything, we don't need to index them.
+        indexed = np.flatnonzero(valid_bboxes(self.bboxes))
+        if len(indexed):
+            sizes = self.bboxes[indexed, 2:] - self.bboxes[indexed, :2]
+            self.cell_width = self.CELL_WIDTH_FACTOR * float(sizes[:, 0].mean())
+            self.cell_height = self.CELL_HEIGHT_FACTOR * float(sizes[:, 1].mean())
+        else:
+            self.cell_width = self.cell_height = 1.0
+
+        first_cells = np.floor_divide(self.bboxes[indexed, :2], (self.cell_width, self.cell_height)).astype(int)
+        last_cells = np.floor_divide(self.bboxes[indexed, 2:], (self.cell_width, self.cell_height)).astype(int)
+        for i, (cx0, cy0), (cx1, cy1) in zip(indexed.tolist(), first_cells.tolist(), last_cells.tolist()):
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    self.cells[(cx, cy)].append(i)
+
+        # Limits of the grid, used to avoid walking cells where there are no words
+        # when the rectangle is bigger than the page.
+        self.bounds = (
+            min(cx for cx, _ in self.cells), min(cy for _, cy in self.cells),
+            max(cx for cx, _ in self.cells), max(cy for _, cy in self.cells),
+        ) if self.cells else (0, 0, -1, -1)
+
+    def query(self, bbox) -> np.ndarray:
+        """Get the indices of the words that intersect the rectangle
+
+        Args:
+            bbox: Rectangle as (x0, y0, x1, y1)
+
+        Returns:
+            The indices in ascending order, the same order you get walking the words list.
+        """
+        bbox = np.asarray(bbox, dtype=np.float64)
+        if not self.cells or not valid_bboxes(bbox.reshape(1, 4))[0]:
+            return np.empty(0, dtype=int)
+
+        cx0 = max(int(bbox[0] // self.cell_width), self.bounds[0])
+        cy0 = max(int(bbox[1] // self.cell_height), self.bounds[1])
+        cx1 = min(int(bbox[2] // self.cell_width), self.bounds[2])
+        cy1 = min(int(bbox[3] // self.cell_height), self.bounds[3])
+
+        candidates = [
+            self.cells[(cx, cy)]
+            for cx in range(cx0, cx1 + 1)
+            for cy in range(cy0, cy1 + 1)
+            if (cx, cy) in self.cells
+        ]
+        if not candidates:
+            return np.empty(0, dtype=int)
+
+        candidates = np.unique(np.concatenate(candidates))
+        return candidates[intersects(self.bboxes[candidates], bbox)]
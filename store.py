@@ -0,0 +1,135 @@
+import json
+import sqlite3
+
+from pathlib import Path
+from typing import Final, NamedTuple, Optional
+
+from profiler import get_profiler
+
+SCHEMA: Final = """
+CREATE TABLE IF NOT EXISTS highlights (
+    id INTEGER PRIMARY KEY,
+    book TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    text TEXT NOT NULL,
+    bboxes TEXT NOT NULL,
+    UNIQUE (book, page)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS highlights_fts USING fts5(book, headers, text);
+"""
+
+class SearchResult(NamedTuple):
+    """Page found by HighlightStore.search"""
+    book: str
+    page_no: int
+    # Header hierarchy with the format ((level, title),)
+    headers: tuple[tuple[int, str], ...]
+    # Text around the matches, they are between [ and ]
+    snippet: str
+    # Rectangle of every line of the highlights ((x0,y0, x1,y1),)
+    bboxes: tuple[tuple[float, ...], ...]
+
+class HighlightStore:
+    """
+    SQLite database with the highlights of every page of every book, with a full
+    text index to search them.
+
+    Every page has one row with its header hierarchy, its markdown text and the
+    rectangles of its highlights. The pages are inserted in batches of BATCH_SIZE
+    in one transaction, a page already stored is replaced by its new text.
+    """
+
+    BATCH_SIZE: Final = 200
+
+    def __init__(self, path: Path):
+        self.path = path
+        # Several processes can write the same database, see process_library
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self.pending: list[tuple[str, int, str, str, str]] = []
+        self.stored = 0
+
+    def __enter__(self) -> "HighlightStore":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
+
+    def add(
+            self,
+            book: str,
+            page_no: int,
+            headers_per_page: list[tuple[int, str]],
+            text: str,
+            bboxes: list[list[float]]
+        ) -> None:
+        """Add a page, it is written with the next batch"""
+        # The line closing every page only adds noise to the index
+        text = text.removesuffix(f"Page: {page_no}\n\n---\n\n")
+        self.pending.append((book, page_no, json.dumps(headers_per_page), text, json.dumps(bboxes)))
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the pending pages in one transaction"""
+        if not self.pending:
+            return
+
+        with get_profiler().stage("storing"), self.connection:
+            for book, page_no, headers, text, bboxes in self.pending:
+                self.connection.execute(
+                    "DELETE FROM highlights_fts WHERE rowid IN (SELECT id FROM highlights WHERE book = ? AND page = ?)",
+                    (book, page_no)
+                )
+                self.connection.execute("DELETE FROM highlights WHERE book = ? AND page = ?", (book, page_no))
+                row_id = self.connection.execute(
+                    "INSERT INTO highlights (book, page, headers, text, bboxes) VALUES (?, ?, ?, ?, ?)",
+                    (book, page_no, headers, text, bboxes)
+                ).lastrowid
+                titles = " > ".join(title for _, title in json.loads(headers))
+                self.connection.execute(
+                    "INSERT INTO highlights_fts (rowid, book, headers, text) VALUES (?, ?, ?, ?)",
+                    (row_id, book, titles, text)
+                )
+        self.stored += len(self.pending)
+        self.pending = []
+
+    def search(self, query: str, limit: int = 20, book: Optional[str] = None) -> list[SearchResult]:
+        """
+        Get the pages matching a FTS5 query, the best matches first.
+
+        Args:
+            query: FTS5 query, words, "phrases", prefix*, AND, OR, NOT and column filters like headers:word
+            limit: Maximum number of pages
+            book: Only search the pages of this book
+
+        Raises:
+            sqlite3.OperationalError: If the query is not valid.
+        """
+        self.flush()
+        rows = self.connection.execute(
+            """
+            SELECT h.book, h.page, h.headers, snippet(highlights_fts, 2, '[', ']', '...', 16), h.bboxes
+            FROM highlights_fts JOIN highlights h ON h.id = highlights_fts.rowid
+            WHERE highlights_fts MATCH ? AND (? IS NULL OR h.book = ?)
+            ORDER BY rank
+            LIMIT ?
+            """,
+            (query, book, book, limit)
+        )
+        return [
+            SearchResult(
+                book,
+                page_no,
+                tuple(tuple(header) for header in json.loads(headers)),
+                snippet,
+                tuple(tuple(bbox) for bbox in json.loads(bboxes)),
+            )
+            for book, page_no, headers, snippet, bboxes in rows
+        ]
@@ -1,12 +1,33 @@
+import multiprocessing
+import os
+import re
+import tempfile
 import unittest
 
-from unittest.mock import MagicMock, patch
-from pdf import PDF
+from pathlib import Path
+from unittest.mock import MagicMock, PropertyMock, patch
+
+import pymupdf
+
+import main
+
+from benchmark import STAGES, generate_pdf, run_benchmark
+from cache import CACHE_FILE, ExtractionCache
+from fonts import FontProfile
+from memory import current_rss, peak_rss
+from pdf import PDF, PageResult
+from profiler import NULL_PROFILER, Profiler, get_profiler
+from spatial import WordGrid, intersecting_pairs, to_bboxes
+from store import HighlightStore
+from toc import HeaderMatcher, TableOfContents
+from words import MARKUP_BOLD_ITALIC, MARKUP_PARAGRAPH_END, WordStore, apply_markup
+from writer import BackgroundWriter, MarkdownWriter
 
 class TestPDF(unittest.TestCase):
     @patch("pymupdf.open")
     def setUp(self, mock_open):
         mock_document = MagicMock()
+        mock_document.page_count = 0
         mock_page = MagicMock()
         mock_open.return_value = mock_page
 
@@ -157,8 +178,7 @@ class TestPDF(unittest.TestCase):
     ###################################################
 
     def run__extract_headers_test(self, text_spans, expected_headers):
-        with patch.object(PDF, "_PDF__get_common_font_size", return_value=[10, 12, 14, 16, 18]) as mock_get_common_font_size, \
-            patch.object(PDF, "_PDF__calculate_dynamic_threshold", return_value=14) as mock_calculate_dynamic_threshold, \
+        with patch.object(PDF, "font_profile", new_callable=PropertyMock, return_value=MagicMock(threshold=14)), \
             patch.object(PDF, "_PDF__process_text_blocks") as mock_process_text_blocks:
         
             mock_process_text_blocks.side_effect = lambda callback: [callback(span) for span in text_spans]
@@ -357,6 +377,198 @@ class TestPDF(unittest.TestCase):
 
     ###################################################
 
+    def test_setup_page_is_lazy(self):
+        self.pdf.setup_page(3)
+        self.pdf.page.get_text.assert_not_called()
+        self.pdf.page.get_textpage.assert_not_called()
+
+    def test_page_is_parsed_once(self):
+        doc = pymupdf.open()
+        page = doc.new_page()
+        page.insert_text((50, 50), "The first line.")
+        page.insert_text((50, 70), "The second line.")
+
+        self.pdf.doc = doc
+        self.pdf.setup_page(1)
+        with patch.object(pymupdf.Page, "get_textpage", autospec=True, side_effect=pymupdf.Page.get_textpage) as get_textpage:
+            self.assertEqual([word[4] for word in self.pdf.words], ["The", "first", "line.", "The", "second", "line."])
+            self.assertEqual(len(self.pdf.data), 2)
+            self.assertEqual(self.pdf.text, "The first line.\nThe second line.\n")
+            get_textpage.assert_called_once()
+
+    def test_sparse_page_is_parsed_once(self):
+        doc = pymupdf.open()
+        page = doc.new_page()
+        page.insert_text((50, 50), "A header far away", fontsize=20)
+        page.insert_text((50, 400), "The highlighted line.")
+        page.insert_text((50, 700), "The last line.")
+        page.add_highlight_annot(page.search_for("highlighted"))
+
+        self.pdf.doc = doc
+        self.pdf.setup_page(1)
+        with patch.object(pymupdf.Page, "get_textpage", autospec=True, side_effect=pymupdf.Page.get_textpage) as get_textpage:
+            self.assertIsNotNone(self.pdf.clip)
+            self.pdf._PDF__extract_highlight_text()
+            self.assertEqual(len(self.pdf.data), 3)
+            self.assertEqual(self.pdf.text.count("\n"), 3)
+            get_textpage.assert_called_once()
+
+        # Only the words of the band are searched
+        self.assertEqual(len(self.pdf.words), 10)
+        self.assertEqual(len(self.pdf.word_grid.bboxes), 3)
+        self.assertEqual([word[4] for word in self.pdf.highlight_words], ["highlighted"])
+
+        page.add_highlight_annot(page.search_for("last"))
+        self.pdf.setup_page(1)
+        self.assertIsNone(self.pdf.clip)
+
+    def test_sparse_pages_same_as_full_pages(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / "book.pdf"
+            generate_pdf(path, pages=12, words_per_page=300, highlights=1, quads=2, seed=3)
+
+            pdf = PDF(str(path))
+            sparse_pages = 0
+            for page_no in range(1, 13):
+                pdf.setup_page(page_no)
+                sparse_pages += pdf.clip is not None
+            self.assertGreater(sparse_pages, 0)
+            expected = list(pdf.iter_pages())
+            with patch.object(PDF, "SPARSE_COVERAGE", 0):
+                self.assertEqual(list(PDF(str(path)).iter_pages()), expected)
+
+    def test__extract_highlight_text_overlapping(self):
+        doc = pymupdf.open()
+        page = doc.new_page()
+        page.insert_text((50, 50), "Every word is taken once.")
+        page.add_highlight_annot(page.search_for("Every word is"))
+        page.add_highlight_annot(page.search_for("word is taken"))
+
+        self.pdf.doc = doc
+        self.pdf.setup_page(1)
+        self.pdf._PDF__extract_highlight_text()
+        self.assertEqual(self.pdf.highlight_indices, [0, 1, 2, 3])
+        self.assertEqual([word[4] for word in self.pdf.highlight_words], ["Every", "word", "is", "taken"])
+
+    def test__extract_highlight_text_overprinted(self):
+        doc = pymupdf.open()
+        page = doc.new_page()
+        for _ in range(2):
+            page.insert_text((50, 50), "Overprinted heading words here.")
+        page.add_highlight_annot(page.search_for("Overprinted heading words here.")[:1])
+
+        self.pdf.doc = doc
+        self.pdf.setup_page(1)
+        self.pdf._PDF__extract_highlight_text()
+        self.assertEqual(len(self.pdf.words), 8)
+        self.assertEqual([word[4] for word in self.pdf.highlight_words], ["Overprinted", "heading", "words", "here."])
+
+    def test__get_all_last_words_in_block(self):
+        doc = pymupdf.open()
+        page = doc.new_page()
+        page.insert_text((50, 50), "A paragraph ends here.")
+        page.insert_text((50, 70), "Then it continues")
+        page.insert_text((50, 90), "until it ends.")
+
+        self.pdf.doc = doc
+        self.pdf.setup_page(1)
+        last_words = self.pdf._PDF__get_all_last_words_in_block()
+        self.assertEqual([word[4] for word in last_words], ["here.", "ends."])
+
+    def test__insert_headers(self):
+        words = [(0, 0, 0, 5, "Before"), (0, 0, 0, 15, "First"), (0, 0, 0, 18, "Second"), (0, 0, 0, 25, "Third")]
+
+        self.pdf.headers = [(0, 0, 0, 10, "Header1"), (0, 0, 0, 20, "Header2")]
+        result, _ = self.pdf._PDF__insert_headers(words)
+        self.assertEqual([word[4] for word in result], [
+            "Before", "\n\n\nHeader1\n\n\n", "First", "Second", "\n\n\nHeader2\n\n\n", "Third"
+        ])
+
+        # Headers not sorted by y use the first range not used yet
+        self.pdf.headers = [(0, 0, 0, 20, "Header2"), (0, 0, 0, 10, "Header1")]
+        result, _ = self.pdf._PDF__insert_headers(words)
+        self.assertEqual([word[4] for word in result], [
+            "Before", "\n\n\nHeader1\n\n\n", "First", "Second", "Third"
+        ])
+
+    def test_get_highlighted_pages(self):
+        doc = pymupdf.open()
+        for text in ["First page", "Second page", "Third page", "Fourth page"]:
+            page = doc.new_page()
+            page.insert_text((50, 50), text)
+        doc[1].add_highlight_annot(doc[1].search_for("Second"))
+        doc[2].add_text_annot((10, 10), "Not a highlight")
+        doc[3].add_highlight_annot(doc[3].search_for("page"))
+
+        self.pdf.doc = doc
+        self.assertEqual(self.pdf.get_highlighted_pages(), [2, 4])
+
+    def test_iter_pages(self):
+        doc = pymupdf.open()
+        for text in ["First page.", "Second page.", "Third page."]:
+            page = doc.new_page()
+            page.insert_text((50, 50), text)
+        doc[1].add_highlight_annot(doc[1].search_for("Second page."))
+
+        with patch("pymupdf.open", return_value=doc):
+            pdf = PDF("document.pdf")
+        results = list(pdf.iter_pages(1))
+
+        self.assertEqual([result.page_no for result in results], [1, 2, 3])
+        self.assertEqual(results[0], PageResult(1, "", (), 0))
+        self.assertEqual(results[1].highlight_count, 1)
+        self.assertIn("Second page.", results[1].text)
+        self.assertTrue(results[1].text.endswith("Page: 2\n\n---\n\n"))
+        # Nothing of the last page is kept
+        self.assertIsNone(pdf.page)
+        self.assertEqual(pdf.highlight_words, [])
+
+    def test_memory_budget_reopens_document(self):
+        doc = pymupdf.open()
+        for text in ["First page.", "Second page."]:
+            doc.new_page().insert_text((50, 50), text)
+        doc[0].add_highlight_annot(doc[0].search_for("First page."))
+        doc[1].add_highlight_annot(doc[1].search_for("Second page."))
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = str(Path(folder) / "document.pdf")
+            doc.save(path)
+            expected = list(PDF(path).iter_pages())
+
+            low_memory = []
+            reopen = PDF.reopen
+
+            def reopen_document(pdf):
+                low_memory.append(pymupdf.TOOLS.set_low_memory())
+                reopen(pdf)
+
+            pdf = PDF(path, memory_budget=1)
+            with patch.object(PDF, "REOPEN_MIN_PAGES", 1), patch.object(PDF, "reopen", autospec=True, side_effect=reopen_document):
+                self.assertEqual(list(pdf.iter_pages()), expected)
+            # Reopened after every page, the device caching is only disabled while the pages are extracted
+            self.assertEqual(low_memory, [True, True])
+            self.assertFalse(pymupdf.TOOLS.set_low_memory())
+            pdf.doc.close()
+
+    def test_get_highlight_fingerprint(self):
+        doc = pymupdf.open()
+        doc.new_page().insert_text((50, 50), "Some highlighted text")
+        doc.new_page()
+        page = doc[0]
+        self.pdf.doc = doc
+
+        self.assertIsNone(self.pdf.get_highlight_fingerprint(1))
+        page.add_highlight_annot(page.search_for("Some"))
+        fingerprint = self.pdf.get_highlight_fingerprint(1)
+        self.assertIsNotNone(fingerprint)
+        self.assertEqual(fingerprint, self.pdf.get_highlight_fingerprint(1))
+
+        page.add_highlight_annot(page.search_for("text"))
+        self.assertNotEqual(fingerprint, self.pdf.get_highlight_fingerprint(1))
+        self.assertIsNone(self.pdf.get_highlight_fingerprint(2))
+
+    ###################################################
+
     @patch.object(PDF, "_PDF__extract_headers")
     @patch.object(PDF, "_PDF__format_text")
     def test_get_headers(self, mock_format_text, mock_extract_headers):
@@ -393,5 +605,533 @@ class TestPDF(unittest.TestCase):
         result = self.pdf.get_bold_italic_text()
         self.assertEqual([], [])
 
+class TestFontProfile(unittest.TestCase):
+    def test_threshold_weighted_by_characters(self):
+        profile = FontProfile()
+        profile.add_span({"size": 10.02, "text": "Body text of the page"})
+        profile.add_span({"size": 20, "text": "Title"})
+        profile.add_span({"size": 30, "text": "  "})
+
+        # 21 characters of size 10 and 5 of size 20
+        self.assertEqual(profile.histogram, {10.0: 21, 20: 5})
+        self.assertEqual(len(profile), 26)
+        std_dev = (21 * 5 / 26 ** 2) ** 0.5 * 10
+        self.assertAlmostEqual(profile.threshold, 10 + std_dev)
+
+    def test_threshold_is_updated(self):
+        profile = FontProfile()
+        self.assertEqual(profile.threshold, 0.0)
+        profile.add(12, 4)
+        self.assertEqual(profile.threshold, 12)
+
+    def test_profile_is_built_once(self):
+        doc = pymupdf.open()
+        for size in (10, 10, 24):
+            doc.new_page().insert_text((50, 50), "Some text", fontsize=size)
+
+        with patch("pymupdf.open", return_value=doc):
+            pdf = PDF("document.pdf")
+        self.assertEqual(pdf.font_profile.histogram, {10: 18, 24: 9})
+        self.assertIs(pdf.font_profile, pdf.font_profile)
+
+class TestWordGrid(unittest.TestCase):
+    def setUp(self):
+        self.words = [
+            (0, 0, 10, 10, "Word1", 0, 0, 0),
+            (12, 0, 30, 10, "Word2", 0, 0, 1),
+            (0, 12, 10, 22, "Word3", 0, 1, 0),
+            (200, 300, 260, 310, "Word4", 1, 0, 0),
+            (5, 5, 5, 5, "Empty", 1, 1, 0),
+        ]
+        self.grid = WordGrid(self.words)
+
+    def test_query_same_as_intersects(self):
+        rects = [
+            pymupdf.Rect(0, 0, 30, 10),
+            pymupdf.Rect(8, 8, 14, 14),
+            pymupdf.Rect(250, 305, 1000, 1000),
+            pymupdf.Rect(-100, -100, 1000, 1000),
+            pymupdf.Rect(100, 100, 110, 110),
+        ]
+        for rect in rects:
+            expected = [i for i, w in enumerate(self.words) if pymupdf.Rect(w[:4]).intersects(rect)]
+            self.assertEqual(self.grid.query(rect).tolist(), expected)
+
+    def test_query_empty_rect(self):
+        self.assertEqual(self.grid.query(pymupdf.Rect(0, 5, 30, 5)).tolist(), [])
+        self.assertEqual(WordGrid([]).query(pymupdf.Rect(0, 0, 10, 10)).tolist(), [])
+
+    def test_intersecting_pairs_same_as_intersects(self):
+        rects = [(0, 0, 30, 10), (8, 8, 14, 14), (10, 0, 12, 10), (5, 5, 5, 5), (0, 10, 30, 20)]
+        expected = [
+            [j for j, rect in enumerate(rects) if pymupdf.Rect(word[:4]).intersects(pymupdf.Rect(rect))]
+            for word in self.words
+        ]
+        self.assertEqual(intersecting_pairs(to_bboxes(self.words), to_bboxes(rects)), expected)
+        self.assertEqual(intersecting_pairs(to_bboxes(self.words), to_bboxes([])), [[] for _ in self.words])
+
+class TestBenchmark(unittest.TestCase):
+    def test_run_benchmark(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / "synthetic.pdf"
+            generate_pdf(path, pages=3, words_per_page=40, highlights=2, quads=2)
+
+            doc = pymupdf.open(path)
+            self.assertEqual(doc.page_count, 3)
+            self.assertEqual([level for level, _, _ in doc.get_toc()], [1, 2, 3, 3, 3])
+            doc.close()
+
+            timings = run_benchmark(path)
+        self.assertEqual(list(timings), list(STAGES))
+        # Every page is timed by the profiler, it is disabled after
+        self.assertEqual({stage: len(times) for stage, times in timings.items()}, dict.fromkeys(STAGES, 3))
+        self.assertIs(get_profiler(), NULL_PROFILER)
+
+class TestProfiler(unittest.TestCase):
+    def test_summary(self):
+        profiler = Profiler()
+        for words in (10, 20, 30):
+            with profiler.stage("setup_page"):
+                pass
+            profiler.count("words", words)
+            profiler.page_done()
+
+        summary = profiler.summary()
+        self.assertEqual(summary["pages"], 3)
+        self.assertEqual(summary["stages"]["setup_page"]["count"], 3)
+        self.assertEqual(summary["counters"]["words"], {"count": 3, "total": 60, "p50": 20, "p90": 28, "p99": 29.8, "max": 30})
+
+    def test_take_and_merge(self):
+        worker, main = Profiler(), Profiler()
+        worker.count("words", 5)
+        worker.page_done()
+        main.merge(worker.take())
+        main.merge(worker.take())
+
+        self.assertEqual(main.pages, 1)
+        self.assertEqual(main.counters, {"words": [5]})
+
+    def test_null_profiler(self):
+        with NULL_PROFILER.stage("setup_page"):
+            NULL_PROFILER.count("words", 5)
+        self.assertFalse(NULL_PROFILER.enabled)
+        self.assertIsNone(NULL_PROFILER.take())
+
+class TestMemory(unittest.TestCase):
+    def test_rss(self):
+        # Both can be None on systems without /proc or the resource module
+        for rss in (current_rss(), peak_rss()):
+            if rss is not None:
+                self.assertGreater(rss, 0)
+
+class TestWordStore(unittest.TestCase):
+    def setUp(self):
+        self.words = [
+            (0.5, 0.0, 10.25, 10.0, "First", 0, 0, 0),
+            (12.0, 0.0, 30.0, 10.0, "word.", 0, 0, 1),
+        ]
+        self.store = WordStore(self.words)
+
+    def test_same_as_words(self):
+        self.assertEqual(len(self.store), 2)
+        self.assertEqual(list(self.store), self.words)
+        self.assertEqual(self.store[-1], self.words[-1])
+        self.assertEqual(self.store.word_numbers, [0, 1])
+        self.assertEqual(self.store.bboxes.tolist(), to_bboxes(self.words).tolist())
+
+    def test_empty(self):
+        store = WordStore([])
+        self.assertEqual(list(store), [])
+        self.assertEqual(store.bboxes.shape, (0, 4))
+
+    def test_apply_markup(self):
+        self.assertEqual(apply_markup("word", 0), "word")
+        self.assertEqual(apply_markup("word", MARKUP_BOLD_ITALIC), "**_word_**")
+        self.assertEqual(apply_markup("word", MARKUP_BOLD_ITALIC | MARKUP_PARAGRAPH_END), "**_word_**\n\n")
+
+class TestExtractionCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = Path(self.folder.name) / "cache.json"
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_get_same_fingerprint(self):
+        cache = ExtractionCache(self.path, "doc")
+        cache.put(3, "abc", [(1, "Header"), (2, "Sub header")], "Text")
+        cache.save()
+
+        cache = ExtractionCache(self.path, "doc")
+        self.assertEqual(cache.get(3, "abc"), ([(1, "Header"), (2, "Sub header")], "Text"))
+        self.assertIsNone(cache.get(3, "other"))
+        self.assertIsNone(cache.get(4, "abc"))
+
+    def test_other_document(self):
+        cache = ExtractionCache(self.path, "doc")
+        cache.put(3, "abc", [], "Text")
+        cache.save()
+
+        self.assertIsNone(ExtractionCache(self.path, "other doc").get(3, "abc"))
+
+class TestHighlightStore(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.store = HighlightStore(Path(self.folder.name) / "highlights.db")
+
+    def tearDown(self):
+        self.store.close()
+        self.folder.cleanup()
+
+    def test_search(self):
+        headers = [(1, "Chapter 1"), (2, "Getting things done")]
+        self.store.add("book", 3, headers, "Write down every open loop.\n\nPage: 3\n\n---\n\n", [[1.0, 2.0, 3.0, 4.0]])
+        self.store.add("other", 5, [], "Loops and more loops.\n\nPage: 5\n\n---\n\n", [])
+
+        results = self.store.search("open loop")
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].book, "book")
+        self.assertEqual(results[0].page_no, 3)
+        self.assertEqual(results[0].headers, ((1, "Chapter 1"), (2, "Getting things done")))
+        self.assertEqual(results[0].bboxes, ((1.0, 2.0, 3.0, 4.0),))
+        self.assertIn("[open] [loop]", results[0].snippet)
+        # The line closing the page is not stored
+        self.assertEqual(self.store.search("page"), [])
+
+        self.assertEqual([result.book for result in self.store.search("loop*")], ["other", "book"])
+        self.assertEqual([result.book for result in self.store.search("loop*", book="book")], ["book"])
+        self.assertEqual([result.page_no for result in self.store.search("headers:things")], [3])
+
+    def test_replace_page(self):
+        self.store.add("book", 3, [], "First text", [])
+        self.store.add("book", 3, [], "Second text", [])
+        self.assertEqual(self.store.search("first"), [])
+        self.assertEqual(len(self.store.search("second")), 1)
+
+    def test_batches(self):
+        with patch.object(HighlightStore, "BATCH_SIZE", 2):
+            for page_no in range(1, 4):
+                self.store.add("book", page_no, [], f"Text {page_no}", [])
+            self.assertEqual(self.store.stored, 2)
+            self.assertEqual(len(self.store.pending), 1)
+
+        self.store.flush()
+        self.assertEqual(self.store.stored, 3)
+
+class TestMarkdownWriter(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.file = Path(self.folder.name) / "notes.md"
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_write_skips_duplicated_pages(self):
+        with MarkdownWriter() as writer:
+            self.assertTrue(writer.write(self.file, "First\n\nPage: 4\n\n---\n\n", 4))
+            self.assertTrue(writer.write(self.file, "Second\n\nPage: 42\n\n---\n\n", 42))
+            self.assertFalse(writer.write(self.file, "Again\n\nPage: 4\n\n---\n\n", 4))
+
+        text = self.file.read_text()
+        self.assertIn("# Created: ", text)
+        self.assertTrue(text.endswith("First\n\nPage: 4\n\n---\n\nSecond\n\nPage: 42\n\n---\n\n"))
+
+    def test_background_writer_keeps_order(self):
+        page = lambda page_no: f"Text {page_no}\n\nPage: {page_no}\n\n---\n\n"
+        with BackgroundWriter(queue_size=2) as writer:
+            for page_no in (1, 2, 3, 2, 4):
+                writer.write(self.file, page(page_no), page_no)
+
+        self.assertEqual(writer.written, 4)
+        self.assertTrue(self.file.read_text().endswith("".join(page(page_no) for page_no in (1, 2, 3, 4))))
+
+    def test_background_writer_raises_errors(self):
+        with self.assertRaises(AttributeError):
+            with BackgroundWriter() as writer:
+                writer.write("", "Text\n\nPage: 1\n\n---\n\n", 1)
+
+    def test_replace_pages(self):
+        page = lambda page_no, text: f"{text}\n\nPage: {page_no}\n\n---\n\n"
+        self.file.write_text(page(3, "Old") + page(5, "Old") + page(7, "Old"))
+        with MarkdownWriter(replace=True) as writer:
+            self.assertTrue(writer.write(self.file, page(5, "First"), 5))
+            self.assertTrue(writer.write(self.file, page(5, "New"), 5))
+            self.assertTrue(writer.write(self.file, page(4, "New"), 4))
+
+        self.assertEqual(self.file.read_text(), page(3, "Old") + page(4, "New") + page(5, "New") + page(7, "Old"))
+
+    def test_write_reads_existing_pages(self):
+        self.file.write_text("Old\n\nPage: 7\n\n---\n\n")
+        with MarkdownWriter() as writer:
+            self.assertFalse(writer.write(self.file, "Old\n\nPage: 7\n\n---\n\n", 7))
+            self.assertTrue(writer.write(self.file, "New\n\nPage: 8\n\n---\n\n", 8))
+
+        self.assertEqual(self.file.read_text(), "Old\n\nPage: 7\n\n---\n\nNew\n\nPage: 8\n\n---\n\n")
+
+    def test_ordered_inserts_pages(self):
+        page = lambda page_no: f"Text {page_no}\n\nPage: {page_no}\n\n---\n\n"
+        with MarkdownWriter(ordered=True) as writer:
+            writer.write(self.file, page(3), 3)
+            writer.write(self.file, page(5), 5)
+        preamble = self.file.read_text()[:-len(page(3) + page(5))]
+
+        with MarkdownWriter(ordered=True) as writer:
+            self.assertTrue(writer.write(self.file, page(4), 4))
+            self.assertTrue(writer.write(self.file, page(1), 1))
+            self.assertFalse(writer.write(self.file, page(5), 5))
+            # Nothing is written until the writer is closed
+            self.assertEqual(self.file.read_text(), preamble + page(3) + page(5))
+
+        self.assertEqual(self.file.read_text(), preamble + page(1) + page(3) + page(4) + page(5))
+
+    def test_ordered_appends_last_pages(self):
+        page = lambda page_no: f"Text {page_no}\n\nPage: {page_no}\n\n---\n\n"
+        self.file.write_text(page(1) + "My notes\n")
+        with MarkdownWriter(ordered=True) as writer:
+            writer.write(self.file, page(3), 3)
+            writer.write(self.file, page(2), 2)
+
+        self.assertEqual(self.file.read_text(), page(1) + "My notes\n" + page(2) + page(3))
+
+class TestMain(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = Path(self.folder.name)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_get_documents(self):
+        for name in ["a.pdf", "b.pdf", "notes.txt", "sub/c.pdf"]:
+            (self.path / name).parent.mkdir(exist_ok=True)
+            (self.path / name).touch()
+        config = {"page_start": 1, "page_end": 5}
+
+        documents = main.get_documents(config, [
+            str(self.path / "*.pdf"),
+            {"pdf_path": str(self.path / "sub" / ".." / "a.pdf"), "page_end": 9},
+            str(self.path / "sub" / "*.pdf"),
+        ])
+        self.assertEqual([document["pdf_path"].name for document in documents], ["a.pdf", "b.pdf", "c.pdf"])
+        # The last item of a PDF found twice gives its options, the others come from the config
+        self.assertEqual((documents[0]["page_start"], documents[0]["page_end"]), (1, 9))
+        self.assertEqual((documents[1]["page_start"], documents[1]["page_end"]), (1, 5))
+
+        self.assertEqual(main.get_documents({"pdf_path": "book.pdf"}), [{"pdf_path": Path("book.pdf")}])
+        # A PDF with glob characters in its name is taken as it is
+        (self.path / "Clean Code [2008].pdf").touch()
+        documents = main.get_documents({}, [str(self.path / "Clean Code [2008].pdf")])
+        self.assertEqual(documents, [{"pdf_path": self.path / "Clean Code [2008].pdf"}])
+
+        # A glob without PDFs is kept, it fails when it is processed
+        missing = str(self.path / "missing" / "*.pdf")
+        documents = main.get_documents({}, [missing, str(self.path / "a.pdf")])
+        self.assertEqual([document["pdf_path"] for document in documents], [Path(missing), self.path / "a.pdf"])
+        summaries = main.process_library(documents[:1], self.path / "notes", auto_pages=True, workers=1)
+        self.assertTrue(summaries[0]["error"].startswith("FileNotFoundError"))
+
+    def test_process_library_errors(self):
+        (self.path / "other").mkdir()
+        generate_pdf(self.path / "book.pdf", pages=2, words_per_page=40, highlights=1)
+        generate_pdf(self.path / "other" / "book.pdf", pages=2, words_per_page=40, highlights=1)
+        documents = [
+            {"pdf_path": self.path / "book.pdf"},
+            {"pdf_path": self.path / "missing.pdf"},
+            {"pdf_path": self.path / "other" / "book.pdf"},
+        ]
+
+        summaries = main.process_library(documents, self.path / "notes", auto_pages=True, workers=1)
+        self.assertEqual([summary["pdf_path"] for summary in summaries], [str(d["pdf_path"]) for d in documents])
+        self.assertNotIn("error", summaries[0])
+        self.assertEqual(summaries[0]["pages"], 2)
+        self.assertTrue(summaries[1]["error"].startswith("FileNotFoundError"))
+        # Both PDFs would write the same folder, only the first one is processed
+        self.assertIn("Same name as", summaries[2]["error"])
+
+    def read_notes(self, folder: Path) -> dict[str, str]:
+        """Text of every markdown file in the folder without the creation date"""
+        return {
+            str(file.relative_to(folder)): re.sub(r"# Created: .*", "", file.read_text(encoding="utf-8"))
+            for file in sorted(folder.rglob("*.md"))
+        }
+
+    def test_process_document_parallel_same_as_sequential(self):
+        pdf_path = self.path / "book.pdf"
+        generate_pdf(pdf_path, pages=8, words_per_page=80, highlights=2, quads=2)
+        document = {"pdf_path": pdf_path}
+
+        main.process_document(document, self.path / "sequential", auto_pages=True, workers=1, use_cache=False)
+        main.process_document(document, self.path / "parallel", auto_pages=True, workers=2, use_cache=False)
+        notes = self.read_notes(self.path / "sequential")
+        self.assertTrue(notes)
+        self.assertEqual(self.read_notes(self.path / "parallel"), notes)
+
+    @unittest.skipUnless(multiprocessing.get_start_method() == "fork", "The workers need the patched PDF")
+    def test_process_document_parallel_error(self):
+        pdf_path = self.path / "book.pdf"
+        generate_pdf(pdf_path, pages=6, words_per_page=40, highlights=1)
+        extract_page = PDF.extract_page
+
+        def failing_extract_page(pdf, page_no):
+            if page_no == 4:
+                raise ValueError("Broken page")
+            return extract_page(pdf, page_no)
+
+        with patch.object(PDF, "extract_page", autospec=True, side_effect=failing_extract_page):
+            with self.assertRaisesRegex(ValueError, "Broken page"):
+                main.process_document(
+                    {"pdf_path": pdf_path}, self.path / "notes", auto_pages=True, workers=2, use_cache=False
+                )
+
+        # The pages before the error are written in order
+        pages = re.findall(r"Page: (\d+)", "".join(self.read_notes(self.path / "notes").values()))
+        self.assertEqual(pages, ["1", "2", "3"])
+
+    @unittest.skipUnless(multiprocessing.get_start_method() == "fork", "The workers need the patched PDF")
+    def test_process_document_parallel_font_profile(self):
+        pdf_path = self.path / "book.pdf"
+        generate_pdf(pdf_path, pages=6, words_per_page=40, highlights=1)
+        build_font_profile = PDF._PDF__build_font_profile
+        parent = os.getpid()
+
+        def parent_build_font_profile(pdf):
+            if os.getpid() != parent:
+                raise AssertionError("Font profile built in a worker")
+            return build_font_profile(pdf)
+
+        with patch.object(PDF, "_PDF__build_font_profile", autospec=True, side_effect=parent_build_font_profile) as build:
+            main.process_document({"pdf_path": pdf_path}, self.path / "notes", auto_pages=True, workers=2, use_cache=False)
+        build.assert_called_once()
+
+        profile = FontProfile()
+        self.assertIs(PDF(str(pdf_path), font_profile=profile).font_profile, profile)
+
+    def test_extract_pages_with_cache(self):
+        pdf_path = self.path / "book.pdf"
+        doc = pymupdf.open()
+        for page_no in range(1, 6):
+            doc.new_page().insert_text((50, 100), f"Notes of page {page_no}.")
+        for page in (doc[0], doc[1], doc[3]):
+            page.add_highlight_annot(page.search_for("Notes"))
+        doc.set_toc([[1, "Chapter", 1], [2, "Section", 1]])
+        doc.save(pdf_path)
+
+        def extract_pages(pdf: PDF) -> tuple[list, list[int]]:
+            cache = ExtractionCache(self.path / CACHE_FILE, pdf.get_document_id())
+            with patch.object(PDF, "extract_page", autospec=True, side_effect=PDF.extract_page) as extract_page:
+                page_texts = list(main.extract_pages(pdf, range(1, 6), cache=cache))
+            cache.save()
+            return page_texts, [call.args[1] for call in extract_page.call_args_list]
+
+        first, extracted = extract_pages(PDF(str(pdf_path)))
+        self.assertEqual(extracted, [1, 2, 4])
+        self.assertEqual([page_no for page_no, _ in first], [1, 2, 3, 4, 5])
+        self.assertIsNone(first[2][1])
+
+        doc = pymupdf.open(pdf_path)
+        doc[4].add_highlight_annot(doc[4].search_for("Notes"))
+        doc.saveIncr()
+        second, extracted = extract_pages(PDF(str(pdf_path)))
+        # Only the page with a new highlight is extracted, the others come from the cache in order
+        self.assertEqual(extracted, [5])
+        self.assertEqual(second[:4], first[:4])
+        self.assertEqual(second[4][0], 5)
+        self.assertEqual(second[4][1][1], "Notes \n\nPage: 5\n\n---\n\n")
+        for page_no, page_text in second:
+            if page_text is not None:
+                self.assertIn(f"Page: {page_no}", page_text[1])
+
+    def test_watch_page_without_headers(self):
+        pdf_path = self.path / "book.pdf"
+        doc = pymupdf.open()
+        for text in ["First page.", "Second page."]:
+            doc.new_page().insert_text((50, 50), text)
+        doc[0].add_highlight_annot(doc[0].search_for("First"))
+        doc[1].add_highlight_annot(doc[1].search_for("Second"))
+        doc.save(pdf_path)
+        doc.close()
+
+        texts = {1: "First", 2: "Second"}
+
+        def extract_page(pdf, page_no):
+            # The second page has a header that is not in the table of contents
+            headers = ((1, "Chapter"), (2, "Section")) if page_no == 1 else ()
+            return PageResult(page_no, f"{texts[page_no]}\n\nPage: {page_no}\n\n---\n\n", headers, 1)
+
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 1:
+                texts[2] = "Second changed"
+                doc = pymupdf.open(pdf_path)
+                doc[1].add_highlight_annot(doc[1].search_for("page"))
+                doc.saveIncr()
+                doc.close()
+            elif len(sleeps) > 2:
+                raise KeyboardInterrupt
+
+        with patch.object(PDF, "extract_page", autospec=True, side_effect=extract_page), \
+                patch.object(main.time, "sleep", side_effect=sleep):
+            main.watch_document({"pdf_path": pdf_path}, self.path / "notes", auto_pages=True, use_cache=False)
+
+        content = (self.path / "notes" / "book" / "Chapter" / "Section.md").read_text(encoding="utf-8")
+        self.assertIn("First\n\nPage: 1", content)
+        self.assertIn("Second changed\n\nPage: 2", content)
+        self.assertEqual(content.count("Page: 2"), 1)
+
+class TestTableOfContents(unittest.TestCase):
+    def test_indices_up_to(self):
+        toc = TableOfContents([
+            [1, '1 Introduction', 29],
+            [2, '1.1 What Is an Algorithm?', 31],
+            [3, 'Exercises 1.1', 35],
+            [1, '2 Evolution', 45],
+        ])
+        self.assertEqual(toc.indices_up_to(10), [])
+        self.assertEqual([toc.entries[i][1] for i in toc.indices_up_to(35)],
+                         ['1 Introduction', '1.1 What Is an Algorithm?', 'Exercises 1.1'])
+        self.assertEqual(len(toc.indices_up_to(100)), 4)
+
+    def test_indices_up_to_keeps_toc_order(self):
+        toc = TableOfContents([
+            [1, '1 Introduction', 29],
+            [1, '2 Fundamentals', 75],
+            [2, '2.2 Asymptotic Notations', 67],
+            [3, 'O-notation', 81],
+            [1, 'Index', -1],
+        ])
+        self.assertEqual(toc.indices_up_to(80), [0, 1, 2, 4])
+        self.assertEqual(toc.indices_up_to(70), [0, 2, 4])
+
+    def test_normalized_titles(self):
+        toc = TableOfContents([[1, '2.2 Notations and Basic Efﬁciency Classes!', 1]])
+        self.assertEqual(toc.entries[toc.indices_up_to(1)[0]][2], '2.2 Notations and Basic Efficiency Classes')
+
+class TestHeaderMatcher(unittest.TestCase):
+    def setUp(self):
+        self.matcher = HeaderMatcher(TableOfContents([
+            [1, '2 Fundamentals of the Analysis of Algorithm Efficiency', 69],
+            [2, '2.2 Asymptotic Notations and Basic Efficiency Classes', 80],
+            [3, 'O-notation', 81],
+            [3, 'Exercises 2.2', 90],
+        ]))
+
+    def test_titles_containing(self):
+        self.assertEqual(self.matcher.titles_containing('2.2 Asymptotic Notations and Basic Efﬁciency Classes'), {1})
+        self.assertEqual(self.matcher.titles_containing('O -notation'), set())
+        self.assertEqual(self.matcher.titles_containing('O-notation'), {2})
+        self.assertEqual(self.matcher.titles_containing('Efficiency'), {0, 1})
+        self.assertEqual(self.matcher.titles_containing('Chapter 7'), set())
+
+    def test_titles_containing_short_headers(self):
+        self.assertEqual(self.matcher.titles_containing('2.'), {1, 3})
+        # Nothing left after removing the symbols, it is part of every title
+        self.assertEqual(self.matcher.titles_containing('- '), {0, 1, 2, 3})
+
+    def test_is_part_of(self):
+        self.assertTrue(self.matcher.is_part_of('## Exercises 2.2', 'Exercises 2.2'))
+        self.assertFalse(self.matcher.is_part_of('Exercises 2.3', 'Exercises 2.2'))
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,106 @@
+from bisect import bisect_right
+from typing import Final
+
+import unicodedata
+import re
+
+# Characters removed from a title before comparing it
+TITLE_PATTERN: Final = re.compile(r"[^\w\s.]")
+
+def normalize_title(title: str) -> str:
+    """Remove the symbols of a title and decompose its ligatures to compare it with other titles"""
+    return unicodedata.normalize("NFKD", TITLE_PATTERN.sub("", title).strip())
+
+class TableOfContents:
+    """
+    Table of contents of a document, sorted by page and with its titles already normalized.
+
+    Having the entries with the next format [(level, title, normalized_title)]
+    """
+
+    def __init__(self, toc: list[list]):
+        """
+        Args:
+            toc: Table of contents as returned by pymupdf [[level, title, page]]
+        """
+        self.entries = [(level, title, normalize_title(title)) for level, title, page, *_ in toc]
+
+        # Indices of the entries sorted by page, the sort is stable so entries
+        # with the same page keep the order they have in the table of contents.
+        self.by_page = sorted(range(len(toc)), key=lambda i: toc[i][2])
+        self.pages = [toc[i][2] for i in self.by_page]
+
+        # Usually the pages of a table of contents are ascending, then the entries
+        # up to a page are just the first entries.
+        self.ascending = self.by_page == list(range(len(toc)))
+        self.min_level = min((level for level, _, _ in self.entries), default=1)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def indices_up_to(self, page_no: int) -> list[int]:
+        """
+        Get the indices of the entries whose page is lower or equal to page_no.
+
+        Returns:
+            The indices in ascending order, the order of the table of contents.
+        """
+        count = bisect_right(self.pages, page_no)
+        if self.ascending:
+            return list(range(count))
+        return sorted(self.by_page[:count])
+
+class HeaderMatcher:
+    """
+    Find the titles of a table of contents that contain a header found in a page.
+
+    A header matches a title when its normalized text is part of the normalized
+    title. The titles are indexed by their trigrams, only the titles having all
+    the trigrams of a header are compared with it.
+    """
+
+    GRAM_SIZE: Final = 3
+
+    def __init__(self, table_of_contents: TableOfContents):
+        self.table_of_contents = table_of_contents
+        self.__normalized: dict[str, str] = {}
+        self.__matches: dict[str, frozenset[int]] = {}
+
+        self.grams: dict[str, set[int]] = {}
+        for index, (_, _, title) in enumerate(table_of_contents.entries):
+            for gram in self.__grams(title):
+                self.grams.setdefault(gram, set()).add(index)
+
+    def __grams(self, text: str) -> set[str]:
+        return {text[i : i + self.GRAM_SIZE] for i in range(len(text) - self.GRAM_SIZE + 1)}
+
+    def normalize(self, text: str) -> str:
+        """Same as normalize_title but remembering the texts already normalized"""
+        normalized = self.__normalized.get(text)
+        if normalized is None:
+            normalized = self.__normalized[text] = normalize_title(text)
+        return normalized
+
+    def titles_containing(self, header: str) -> frozenset[int]:
+        """Get the indices of the table of contents entries that contain the header"""
+        matches = self.__matches.get(header)
+        if matches is not None:
+            return matches
+
+        normalized = self.normalize(header)
+        entries = self.table_of_contents.entries
+        if len(normalized) < self.GRAM_SIZE:
+            # Too short to be indexed, compare it with all the titles
+            candidates: set[int] = set(range(len(entries)))
+        else:
+            postings = sorted((self.grams.get(gram, set()) for gram in self.__grams(normalized)), key=len)
+            candidates = postings[0].intersection(*postings[1:])
+
+        matches = self.__matches[header] = frozenset(
+            index for index in candidates if normalized in entries[index][2]
+        )
+        return matches
+
+    def is_part_of(self, header: str, title: str) -> bool:
+        """Check if the normalized header is part of the normalized title"""
+        return self.normalize(header) in self.normalize(title)
@@ -0,0 +1,97 @@
+from typing import Final, Iterator
+
+import numpy as np
+
+# Coordinates and numbers of every word, the text is kept apart
+WORD_DTYPE: Final = np.dtype([
+    ("x0", np.float64), ("y0", np.float64), ("x1", np.float64), ("y1", np.float64),
+    ("block_no", np.int32), ("line_no", np.int32), ("word_no", np.int32),
+])
+
+# Markup of a word applied when the text is formatted, see PDF.__format_text
+MARKUP_BOLD_ITALIC: Final = 1
+MARKUP_PARAGRAPH_END: Final = 2
+
+def apply_markup(text: str, markup: int) -> str:
+    """Get the text of a word with its markup, bold/italic goes first"""
+    if markup & MARKUP_BOLD_ITALIC:
+        text = f"**_{text}_**"
+    if markup & MARKUP_PARAGRAPH_END:
+        text = text + "\n\n"
+    return text
+
+def sort_words(words: list[tuple], tolerance: float = 3) -> list[tuple]:
+    """
+    Sort the words line by line in the same order of pymupdf get_text("words", sort=True),
+    without building a Rect for every word.
+
+    A word is in the current line when its top or bottom is within tolerance of the
+    rectangle of the line, every line is sorted by x.
+    """
+    words = sorted(words, key=lambda w: (w[3], w[0]))
+    if not words:
+        return words
+
+    sorted_words: list[tuple] = []
+    line = [words[0]]
+    lx0, ly0, lx1, ly1 = words[0][:4]
+    for word in words[1:]:
+        x0, y0, x1, y1 = word[:4]
+        if abs(y0 - ly0) <= tolerance or abs(y1 - ly1) <= tolerance:
+            line.append(word)
+            # Union of the rectangles like pymupdf, empty rectangles are ignored
+            if x0 >= x1 or y0 >= y1:
+                continue
+            if lx0 >= lx1 or ly0 >= ly1:
+                lx0, ly0, lx1, ly1 = x0, y0, x1, y1
+            else:
+                lx0, ly0, lx1, ly1 = min(lx0, x0), min(ly0, y0), max(lx1, x1), max(ly1, y1)
+        else:
+            line.sort(key=lambda w: w[0])
+            sorted_words.extend(line)
+            line = [word]
+            lx0, ly0, lx1, ly1 = x0, y0, x1, y1
+
+    line.sort(key=lambda w: w[0])
+    sorted_words.extend(line)
+    return sorted_words
+
+class WordStore:
+    """
+    Words of a page in a structured array with their texts in a list.
+
+    It behaves as the list of words returned by pymupdf, every item is built as
+    the tuple (x0,y0, x1,y1, "text", block_no, line_no, word_no) only when it is read.
+    """
+
+    def __init__(self, words: list[tuple]):
+        """
+        Args:
+            words: Tuple with information [(x0,y0, x1,y1, "text", block_no, line_no, word_no)]
+        """
+        # Filled one field at a time, the words are not copied into other tuples
+        self.records = np.empty(len(words), dtype=WORD_DTYPE)
+        for position, field in zip((0, 1, 2, 3, 5, 6, 7), WORD_DTYPE.names):
+            self.records[field] = [word[position] for word in words]
+        self.texts: list[str] = [word[4] for word in words]
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __getitem__(self, index: int) -> tuple:
+        x0, y0, x1, y1, block_no, line_no, word_no = self.records[index].tolist()
+        return x0, y0, x1, y1, self.texts[index], block_no, line_no, word_no
+
+    def __iter__(self) -> Iterator[tuple]:
+        for index in range(len(self)):
+            yield self[index]
+
+    @property
+    def bboxes(self) -> np.ndarray:
+        """Coordinates of the words as a Nx4 array"""
+        return np.column_stack([self.records[field] for field in ("x0", "y0", "x1", "y1")]) \
+            if len(self) else np.empty((0, 4), dtype=np.float64)
+
+    @property
+    def word_numbers(self) -> list[int]:
+        return self.records["word_no"].tolist()
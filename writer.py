@@ -0,0 +1,242 @@
+import logging
+import os
+import re
+
+from datetime import datetime
+from pathlib import Path
+from queue import Queue
+from threading import Thread
+from typing import Final, Optional, TextIO
+
+from profiler import get_profiler
+
+# Line added by the extractor at the end of the text of every page
+PAGE_PATTERN: Final = re.compile(r"^Page: (\d+)$", re.MULTILINE)
+
+# End of the text of every page, used to split a file in pages
+SEGMENT_END_PATTERN: Final = re.compile(rb"^Page: (\d+)\n\n---\n\n", re.MULTILINE)
+
+# Header written when a file is created
+PREAMBLE_PATTERN: Final = re.compile(rb"\A\n---\n\n# Created: [^\n]*\n\n---\n\n")
+
+def create_preamble() -> str:
+    return f"""
+---
+
+# Created: {datetime.now().isoformat(timespec="seconds")}
+
+---\n\n"""
+
+def find_page_files(folder: Path) -> dict[int, Path]:
+    """Get the markdown file of every page written in the folder {page_no: file}"""
+    page_files = {}
+    for file in sorted(folder.rglob("*.md")):
+        for page in PAGE_PATTERN.findall(file.read_text(encoding="utf-8")):
+            page_files.setdefault(int(page), file)
+    return page_files
+
+class MarkdownWriter:
+    """
+    Write the text of the pages in markdown files skipping the pages already written.
+
+    The pages of every file are read once per run and kept in memory, and the file
+    of the last page stays open while the next pages go to the same file.
+
+    In ordered mode the pages are kept until close, then every file gets its new
+    pages inserted by page number with only one rewrite of the file.
+
+    In replace mode the pages already written are replaced by the new text instead
+    of being skipped, the pages are inserted like in ordered mode.
+    """
+
+    def __init__(self, ordered: bool = False, replace: bool = False):
+        self.ordered = ordered or replace
+        self.replace = replace
+        self.pages: dict[Path, set[int]] = {}
+        # Pages in every file with format [(page_no, start, end)], start and end are byte offsets
+        self.segments: dict[Path, list[tuple[int, int, int]]] = {}
+        self.pending: dict[Path, list[tuple[int, str]]] = {}
+        self.file: Optional[Path] = None
+        self.handle: Optional[TextIO] = None
+
+    def __enter__(self) -> "MarkdownWriter":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Flush and close the open file, in ordered mode insert the pending pages"""
+        if self.handle is not None:
+            self.handle.close()
+        self.file, self.handle = None, None
+
+        pending, self.pending = self.pending, {}
+        for file, pages in pending.items():
+            self.__insert_pages(file, pages)
+            # The offsets changed, read the file again if it is used later
+            self.pages.pop(file, None)
+            self.segments.pop(file, None)
+
+    def written_pages(self, file: Path) -> set[int]:
+        """Get the pages already written in the file, it is read only the first time"""
+        pages = self.pages.get(file)
+        if pages is None:
+            content = file.read_bytes() if file.exists() else b""
+            pages = {int(page) for page in PAGE_PATTERN.findall(content.decode("utf-8"))}
+            self.pages[file] = pages
+            self.segments[file] = self.__index_segments(content)
+        return pages
+
+    def __index_segments(self, content: bytes) -> list[tuple[int, int, int]]:
+        """Split the file in the text of every page, the text before a 'Page: X' belongs to page X"""
+        preamble = PREAMBLE_PATTERN.match(content)
+        start = preamble.end() if preamble else 0
+
+        segments = []
+        for match in SEGMENT_END_PATTERN.finditer(content, start):
+            segments.append((int(match.group(1)), start, match.end()))
+            start = match.end()
+        return segments
+
+    def __insert_pages(self, file: Path, pages: list[tuple[int, str]]) -> None:
+        """Write the pages in the file sorted by page number, rewriting the file only if needed"""
+        pages.sort(key=lambda page: page[0])
+        segments = self.segments.get(file, [])
+        new_pages = {page_no for page_no, _ in pages}
+
+        if not file.exists():
+            logging.info(f"Markdown file '{file}' doesn't exist, creating file with PDF pages {[p for p, _ in pages]}")
+            file.write_text(create_preamble() + "".join(text for _, text in pages), encoding="utf-8")
+            return
+
+        # New pages after the last one, there is no need to rewrite the file
+        if not segments or pages[0][0] > max(page_no for page_no, _, _ in segments):
+            logging.info(f"Markdown file exist, appending PDF pages {[p for p, _ in pages]} to '{file}'")
+            with open(file, mode="a", encoding="utf-8") as f:
+                f.write("".join(text for _, text in pages))
+            return
+
+        logging.info(f"Markdown file exist, inserting PDF pages {[p for p, _ in pages]} in '{file}'")
+        content = file.read_bytes()
+        preamble, tail = content[:segments[0][1]], content[segments[-1][2]:]
+        merged = [
+            (page_no, content[start:end])
+            for page_no, start, end in segments
+            if not (self.replace and page_no in new_pages)
+        ]
+        merged.extend((page_no, text.encode("utf-8")) for page_no, text in pages)
+        # Stable sort, pages already in the file keep their order between them
+        merged.sort(key=lambda page: page[0])
+
+        temp_file = file.with_name(file.name + ".tmp")
+        temp_file.write_bytes(preamble + b"".join(text for _, text in merged) + tail)
+        os.replace(temp_file, file)
+
+    def write(self, file: Path, text: str, page_no: int) -> bool:
+        """Create a new file if it doesn't exist or append the text to an existing file
+
+        Returns:
+            bool: True if the text was written, False if the page was already in the file.
+        """
+        written_pages = self.written_pages(file)
+        text_pages = {int(page) for page in PAGE_PATTERN.findall(text)}
+        if text_pages & written_pages and not self.replace:
+            logging.info(f"Page {page_no} already exist. Skipping.")
+            return False
+
+        written_pages.update(text_pages)
+        if self.ordered:
+            pending = self.pending.setdefault(file, [])
+            if self.replace:
+                # Only the last text of a page is written
+                pending[:] = [page for page in pending if page[0] != page_no]
+            pending.append((page_no, text))
+            return True
+
+        if file != self.file:
+            if self.handle is not None:
+                self.handle.close()
+            if not file.exists():
+                logging.info(f"Markdown file '{file}' doesn't exist, creating file with PDF page {page_no}")
+                self.handle = open(file, mode="w", encoding="utf-8")
+                self.handle.write(create_preamble())
+            else:
+                logging.info(f"Markdown file exist, using existing file '{file}' with PDF page {page_no}")
+                self.handle = open(file, mode="a", encoding="utf-8")
+            self.file = file
+        else:
+            logging.info(f"Markdown file exist, using existing file '{file}' with PDF page {page_no}")
+
+        self.handle.write(text)
+        return True
+
+class BackgroundWriter:
+    """
+    Write the pages with a MarkdownWriter in a thread while the next pages are extracted.
+
+    The pages go through a bounded queue, they are written in the same order they
+    were sent and the pages already written are skipped like in MarkdownWriter.
+    """
+
+    # Pages waiting to be written, the extraction waits when the queue is full
+    QUEUE_SIZE: Final = 64
+
+    def __init__(self, ordered: bool = False, queue_size: int = QUEUE_SIZE, replace: bool = False):
+        self.writer = MarkdownWriter(ordered, replace)
+        self.queue: Queue[Optional[tuple[Path, str, int]]] = Queue(maxsize=queue_size)
+        self.written = 0
+        self.error: Optional[Exception] = None
+        self.thread = Thread(target=self.__run, name="markdown-writer", daemon=True)
+        self.thread.start()
+
+    def __enter__(self) -> "BackgroundWriter":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def write(self, file: Path, text: str, page_no: int) -> None:
+        """Send the page to the writer thread, errors of the previous pages are raised here"""
+        self.__raise_error()
+        self.queue.put((file, text, page_no))
+
+    def close(self) -> None:
+        """Wait until every page is written and close the files"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.__raise_error()
+
+    def __raise_error(self) -> None:
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def __run(self) -> None:
+        profiler = get_profiler()
+        try:
+            while (page := self.queue.get()) is not None:
+                if self.error is not None:
+                    # Keep taking the pages, the extraction can't wait for a failed writer
+                    continue
+
+                file, text, page_no = page
+                try:
+                    with profiler.stage("writing"):
+                        is_written = self.writer.write(file, text, page_no)
+                        # Nothing else to write for now, let the text reach the file
+                        if self.queue.empty() and self.writer.handle is not None:
+                            self.writer.handle.flush()
+                except Exception as error:
+                    self.error = error
+                    continue
+
+                if is_written:
+                    self.written += 1
+                    profiler.count("bytes_written", len(text.encode("utf-8")))
+        finally:
+            try:
+                self.writer.close()
+            except Exception as error:
+                self.error = self.error or error